@@ -15,6 +15,9 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from .animation import *
 from .controller import *
+from .emulator import *
+from .framebuffer import *
 from .graphics import *
 from .server import *
\ No newline at end of file
@@ -0,0 +1,150 @@
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+from PIL import Image, ImageSequence
+
+from .controller import *
+from .graphics import *
+
+class Animation(object):
+    """
+    A sequence of frames which have been rendered and packed in advance, along with the duration of each frame in seconds.
+    All frames are stored in one bytearray in the format used for serial communication.
+    """
+
+    def __init__(self, width, height, frame_size = None):
+        self.width = width
+        self.height = height
+        self.frame_size = frame_size or width * ((height + 7) // 8)
+        self.data = bytearray()
+        self.durations = []
+
+    @classmethod
+    def from_image(cls, image, width, height = 16, default_duration = 0.1, dither = 'threshold', threshold = 127, **kwargs):
+        """
+        Decode all frames of an (animated) image, positioning them like FlipdotGraphics.bitmap() using the given keyword arguments.
+        Frames without a duration of their own are shown for 'default_duration' seconds.
+        The frames are binarized together using the given dither mode, see binarize().
+        """
+
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        frames = []
+        durations = []
+        for frame in ImageSequence.Iterator(image):
+            frames.append(frame.convert('RGBA'))
+            duration = frame.info.get('duration')
+            durations.append(duration / 1000 if duration else default_duration)
+
+        values = binarize_frames(frames, dither, threshold)
+        animation = cls(width, height)
+        graphics = FlipdotGraphics(DummyFlipdotController(width, height))
+        for frame, value, duration in zip(frames, values, durations):
+            graphics.init_image()
+            # Keep the transparency of the frame, with the binarized pixels as its color
+            graphics.bitmap(Image.merge('LA', (value.convert('L'), frame.getchannel('A'))), **kwargs)
+            animation.add_frame(graphics.fb.data, duration)
+        return animation
+
+    def add_frame(self, bitmap, duration):
+        if len(bitmap) != self.frame_size:
+            raise ValueError("Frame has {0} bytes, expected {1}".format(len(bitmap), self.frame_size))
+        self.data += bitmap
+        self.durations.append(duration)
+
+    def __len__(self):
+        return len(self.durations)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Frame index out of range")
+        return memoryview(self.data)[index*self.frame_size:(index+1)*self.frame_size]
+
+    @property
+    def total_duration(self):
+        return sum(self.durations)
+
+class AnimationPlayer(object):
+    """
+    Plays an animation on a controller, keeping to the frame durations as closely as possible.
+    Every frame has a fixed deadline relative to the start of the animation, so the time spent transmitting
+    a frame is taken from the time it is shown instead of delaying the rest of the animation.
+    If transmitting falls so far behind that a frame's time slot has passed completely, that frame is dropped.
+    """
+
+    def __init__(self, controller, animation, speed = 1.0):
+        self.controller = controller
+        self.animation = animation
+        self.speed = speed
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames_shown = 0
+        self.frames_dropped = 0
+        self.time_played = 0.0
+        self.time_scheduled = 0.0
+        self.transmit_time = 0.0
+
+    def play(self, loop = False):
+        while True:
+            self.play_once()
+            if not loop:
+                break
+
+    def play_once(self):
+        start = time.monotonic()
+        deadline = start
+        last_index = len(self.animation) - 1
+        try:
+            for index, duration in enumerate(self.animation.durations):
+                deadline += duration / self.speed
+                # Never drop the last frame, so the animation always ends on the correct picture.
+                # Frames without a duration are meant to be shown as fast as possible and are never dropped either.
+                if duration and time.monotonic() >= deadline and index != last_index:
+                    self.frames_dropped += 1
+                    continue
+                send_start = time.monotonic()
+                self.controller.send_bitmap(self.animation[index])
+                self.transmit_time += time.monotonic() - send_start
+                self.frames_shown += 1
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            self.time_played += time.monotonic() - start
+            self.time_scheduled += deadline - start
+
+    @property
+    def target_fps(self):
+        total = self.frames_shown + self.frames_dropped
+        return total / self.time_scheduled if self.time_scheduled else 0.0
+
+    @property
+    def achieved_fps(self):
+        return self.frames_shown / self.time_played if self.time_played else 0.0
+
+    def get_stats(self):
+        return {
+            'frames_shown': self.frames_shown,
+            'frames_dropped': self.frames_dropped,
+            'target_fps': self.target_fps,
+            'achieved_fps': self.achieved_fps,
+            'avg_transmit_time': self.transmit_time / self.frames_shown if self.frames_shown else 0.0
+        }
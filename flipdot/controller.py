@@ -15,8 +15,12 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import concurrent.futures
 import serial
+import threading
 import time
+import weakref
 from PIL import Image, ImageDraw, ImageFont
 
 from .utils import *
@@ -26,7 +30,9 @@ class MatrixError(Exception):
         0xE0: "Timeout",
         0xEE: "Generic Error",
         0xFF: "Success",
-          -1: "No response from controller"
+          -1: "No response from controller",
+          -2: "Display parked after repeated failures",
+          -3: "Serial port error"
     }
 
     def __init__(self, code = None, response = None):
@@ -42,14 +48,146 @@ class MatrixError(Exception):
     def __str__(self):
         return "{0}: {1}".format(self.code, self.description)
 
+class DisplayHealth(object):
+    """
+    Keeps track of how a display answers, to derive a timeout for it and to park it if it stops answering.
+    The timeout follows the smoothed acknowledgement time plus four times its variation, like TCP's retransmission timeout,
+    and doubles with every consecutive failure. Until the first acknowledgement, 'initial_timeout' is used.
+    Flipping dots takes time the acknowledgement times of small updates don't show, so 'column_time' seconds are added
+    for every column a transaction may flip. A display that misses the timeout while flipping more columns than it has
+    ever acknowledged isn't counted as failing once; the time per column is doubled instead.
+    After 'failure_threshold' consecutive failures the display is parked, so requests fail immediately
+    instead of blocking the bus. A display that has never answered, e.g. because it isn't connected, is parked after its first failure. A parked display gets one probe request after a backoff which doubles
+    with every failed probe, up to 'max_backoff' seconds.
+    """
+
+    def __init__(self, min_timeout = 0.05, initial_timeout = 0.5, max_timeout = 5.0, column_time = 0.01, failure_threshold = 3,
+                 backoff = 1.0, max_backoff = 60.0):
+        self.min_timeout = min_timeout
+        self.initial_timeout = initial_timeout
+        self.max_timeout = max_timeout
+        self.column_time = column_time
+        self.failure_threshold = failure_threshold
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = 'ok'
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = backoff
+        self.next_probe = None
+        self.consecutive_failures = 0
+        self.max_columns = 0
+        self.tolerated_failure = False
+        self.successes = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_success = None
+
+    def get_timeout(self, columns = 0):
+        # The timeout for a transaction flipping up to 'columns' columns
+        if self.srtt is None:
+            return min(self.initial_timeout + columns * self.column_time, self.max_timeout)
+        timeout = max(self.min_timeout, self.srtt + 4 * self.rttvar) * 2 ** self.consecutive_failures + columns * self.column_time
+        return min(timeout, self.max_timeout)
+
+    def allow_request(self):
+        # Parked displays only get a request when their probe is due
+        if self.state == 'ok':
+            return True
+        if time.monotonic() >= self.next_probe:
+            self.state = 'probing'
+            return True
+        return False
+
+    def is_available(self):
+        return self.state == 'ok' or time.monotonic() >= self.next_probe
+
+    def record_success(self, latency, columns = 0):
+        if self.srtt is None:
+            self.srtt = latency
+            self.rttvar = latency / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - latency)
+            self.srtt = 0.875 * self.srtt + 0.125 * latency
+        self.state = 'ok'
+        self.backoff = self.initial_backoff
+        self.next_probe = None
+        self.consecutive_failures = 0
+        self.max_columns = max(self.max_columns, columns)
+        self.tolerated_failure = False
+        self.successes += 1
+        self.last_success = time.time()
+
+    def record_failure(self, error, columns = 0):
+        self.failures += 1
+        self.last_error = str(error)
+        if (self.state == 'ok' and self.srtt is not None and columns > self.max_columns
+                and not self.consecutive_failures and not self.tolerated_failure):
+            # The display may just need longer to flip a frame larger than any before
+            self.tolerated_failure = True
+            self.column_time *= 2
+            return
+        self.consecutive_failures += 1
+        if self.state == 'probing':
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        if self.state == 'probing' or self.srtt is None or self.consecutive_failures >= self.failure_threshold:
+            self.state = 'parked'
+            self.next_probe = time.monotonic() + self.backoff
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'ack_time': self.srtt,
+            'ack_time_variation': self.rttvar,
+            'timeout': self.get_timeout(),
+            'column_time': self.column_time,
+            'consecutive_failures': self.consecutive_failures,
+            'successes': self.successes,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_success': self.last_success,
+            'next_probe_in': max(0.0, self.next_probe - time.monotonic()) if self.next_probe is not None else None
+        }
+
 class FlipdotController(object):
-    def __init__(self, port, width, height = 16, using_mux = False, mux_port = 0):
+    """
+    Controls a single display. The last bitmap acknowledged by the display is remembered,
+    so sending the same bitmap again is skipped unless 'force' is set.
+    If 'partial_updates' is enabled, only the range of changed columns is sent using the 0xA5 command.
+    Firmware that doesn't know this command answers with an error, after which full bitmaps are sent again.
+    The responsiveness of the display is tracked in 'health' (see DisplayHealth), which sets the timeout of every transaction.
+    If the serial port fails, e.g. because the adapter was unplugged, it is reopened in place so every controller sharing it recovers.
+    """
+
+    PARTIAL_UPDATE_OVERHEAD = 4
+    MUX_HEADER_LENGTH = 4
+    # Every controller reads the port in steps of this length, so displays sharing it never have to reconfigure it
+    READ_TIMEOUT = 0.01
+
+    def __init__(self, port, width, height = 16, using_mux = False, mux_port = 0, partial_updates = False):
         self.port = port
         self.width = width
         self.height = height
         self.using_mux = using_mux
         self.mux_port = mux_port
-        self.message = bytearray()
+        self.partial_updates = partial_updates
+        self.partial_updates_supported = None
+        # Messages are assembled behind room for the mux header, so a whole transaction can be written at once
+        self.tx_buffer = bytearray(self.MUX_HEADER_LENGTH + 3 + 2*width)
+        self.message_length = 0
+        self.last_bitmap = None
+        self.last_dirty_ranges = []
+        self.stats = {
+            'transactions': 0,
+            'bytes_sent': 0,
+            'frames_sent': 0,
+            'frames_skipped': 0,
+            'partial_updates': 0,
+            'transactions_saved': 0,
+            'bytes_saved': 0,
+            'port_reopens': 0
+        }
+        self.health = DisplayHealth()
         self.ser = get_serial_port(port)
 
     def write(self, data):
@@ -57,14 +195,72 @@ class FlipdotController(object):
             data = bytes([data])
         self.ser.write(data)
 
-    def communicate(self):
+    @property
+    def message(self):
+        return memoryview(self.tx_buffer)[self.MUX_HEADER_LENGTH:self.MUX_HEADER_LENGTH + self.message_length]
+
+    def get_frame(self):
+        # The prepared message including the mux header if needed, as a view on the transmit buffer
         if self.using_mux:
             self.init_mux_message()
-        self.write(self.message)
-        return self.check_status()
+            start = 0
+        else:
+            start = self.MUX_HEADER_LENGTH
+        return memoryview(self.tx_buffer)[start:self.MUX_HEADER_LENGTH + self.message_length]
 
-    def check_status(self):
+    def communicate(self, columns = 0):
+        # 'columns' is the number of columns the transaction may flip, which the display needs time for
+        if not self.health.allow_request():
+            raise MatrixError(-2)
+        frame = self.get_frame()
+        # The time the frame spends on the wire doesn't say anything about the display, so it's added to the timeout separately
+        transmit_time = len(frame) * 10 / getattr(self.ser, 'baudrate', 115200)
+        try:
+            # Every transaction is answered before the next one starts, so anything waiting now is a late answer to an earlier one
+            self.ser.flushInput()
+            if self.ser.timeout != self.READ_TIMEOUT:
+                self.ser.timeout = self.READ_TIMEOUT
+            start = time.monotonic()
+            self.write(frame)
+            self.stats['transactions'] += 1
+            self.stats['bytes_sent'] += len(frame)
+            status = self.check_status(start + self.health.get_timeout(columns) + transmit_time)
+        except (serial.SerialException, OSError) as err:
+            self.health.record_failure(err)
+            self.reopen_port()
+            raise MatrixError(-3)
+        except MatrixError as err:
+            # An error code is still an answer, only a missing one counts against the display's health
+            if err.code == -1:
+                self.health.record_failure(err, columns)
+            else:
+                self.health.record_success(max(0.0, time.monotonic() - start - transmit_time))
+            raise
+        self.health.record_success(max(0.0, time.monotonic() - start - transmit_time), columns)
+        return status
+
+    def reopen_port(self):
+        # Reopen the serial port object itself, so all controllers sharing it can use it again.
+        # Only this controller is invalidated, the owner of the other controllers has to invalidate them (see MatrixError -3).
+        try:
+            self.ser.close()
+            self.ser.open()
+        except (serial.SerialException, OSError):
+            return False
+        self.stats['port_reopens'] += 1
+        self.invalidate()
+        return True
+
+    def get_health(self):
+        health = self.health.to_dict()
+        health['stats'] = dict(self.stats)
+        return health
+
+    def check_status(self, deadline = None):
+        # Wait for the status byte until 'deadline' (a time.monotonic() value), or for one read if it's None
         status = self.ser.read(1)
+        while not status and deadline is not None and time.monotonic() < deadline:
+            status = self.ser.read(1)
         if status:
             status = ord(status)
         else:
@@ -75,46 +271,259 @@ class FlipdotController(object):
 
     def init_mux_message(self):
         # If an Arduino-based serial port muxer is used, this is used to add mux control data to every sent message
-        self.write(0xF0)
-        self.write(0xC0 + self.mux_port)
-        len_msb = len(self.message) >> 8
-        len_lsb = len(self.message) & 0xFF
-        self.write(len_msb)
-        self.write(len_lsb)
+        self.tx_buffer[0] = 0xF0
+        self.tx_buffer[1] = 0xC0 + self.mux_port
+        self.tx_buffer[2] = self.message_length >> 8
+        self.tx_buffer[3] = self.message_length & 0xFF
 
     def prepare_message(self, *args):
-        self.message = bytearray([0xFF])
+        # Assemble the message in place in the transmit buffer, growing it only if a message doesn't fit
+        length = 1 + sum(1 if type(arg) is int else len(arg) for arg in args)
+        if self.MUX_HEADER_LENGTH + length > len(self.tx_buffer):
+            self.tx_buffer = bytearray(self.MUX_HEADER_LENGTH + length)
+        buf = memoryview(self.tx_buffer)
+        pos = self.MUX_HEADER_LENGTH
+        buf[pos] = 0xFF
+        pos += 1
         for arg in args:
             if type(arg) is int:
-                self.message.append(arg)
+                buf[pos] = arg
+                pos += 1
             else:
-                self.message += bytearray(arg)
+                buf[pos:pos + len(arg)] = arg
+                pos += len(arg)
+        self.message_length = length
 
-    def send_bitmap(self, bitmap):
-        if type(bitmap) != bytearray:
+    def get_dirty_ranges(self, old_bitmap, new_bitmap, col_bytes = 2):
+        # Ranges of changed columns as (first, last + 1) tuples
+        if old_bitmap is None or len(old_bitmap) != len(new_bitmap):
+            return [(0, len(new_bitmap) // col_bytes)]
+        ranges = []
+        start = None
+        for x in range(len(new_bitmap) // col_bytes):
+            changed = old_bitmap[x*col_bytes:(x+1)*col_bytes] != new_bitmap[x*col_bytes:(x+1)*col_bytes]
+            if changed and start is None:
+                start = x
+            elif not changed and start is not None:
+                ranges.append((start, x))
+                start = None
+        if start is not None:
+            ranges.append((start, len(new_bitmap) // col_bytes))
+        return ranges
+
+    def invalidate(self):
+        # Forget the displayed bitmap, e.g. if the display might have been reset
+        self.last_bitmap = None
+
+    def send_bitmap(self, bitmap, force = False):
+        if not isinstance(bitmap, (bytes, bytearray, memoryview)):
             bitmap = bytearray(bitmap)
         # Pad bitmap to display width if necessary to avoid memory contents filling the rest of the display
         if len(bitmap) < 2*self.width:
-            bitmap += bytearray([0] * (2*self.width - len(bitmap)))
+            bitmap = bytes(bitmap) + bytes(2*self.width - len(bitmap))
+        full_length = len(bitmap) + 3 + (4 if self.using_mux else 0)
+
+        if not force and self.last_bitmap == bitmap:
+            self.last_dirty_ranges = []
+            self.stats['frames_skipped'] += 1
+            self.stats['transactions_saved'] += 1
+            self.stats['bytes_saved'] += full_length
+            return 0xFF
+
+        self.last_dirty_ranges = self.get_dirty_ranges(self.last_bitmap, bitmap)
+        old_bitmap = self.last_bitmap
+        # The displayed bitmap is unknown until the controller has acknowledged the new one
+        self.last_bitmap = None
+
+        partial_timed_out = False
+        if self.partial_updates and self.partial_updates_supported is not False and old_bitmap is not None and not force:
+            # Send the span from the first to the last changed column in one transaction
+            start, end = self.last_dirty_ranges[0][0], self.last_dirty_ranges[-1][1]
+            if (end - start) * 2 + self.PARTIAL_UPDATE_OVERHEAD < len(bitmap):
+                self.prepare_message(0xA5, start, end - start, bitmap[start*2:end*2])
+                try:
+                    status = self.communicate(sum(last - first for first, last in self.last_dirty_ranges))
+                except MatrixError as err:
+                    if err.code not in (0xEE, -1) or self.partial_updates_supported:
+                        raise
+                    # The firmware doesn't know the command (it either rejects it or doesn't answer at all),
+                    # stick to full bitmaps from now on
+                    self.partial_updates_supported = False
+                    partial_timed_out = err.code == -1
+                else:
+                    self.partial_updates_supported = True
+                    self.last_bitmap = bytes(bitmap)
+                    self.stats['frames_sent'] += 1
+                    self.stats['partial_updates'] += 1
+                    self.stats['bytes_saved'] += full_length - len(self.message) - (4 if self.using_mux else 0)
+                    return status
+
         self.prepare_message(0xA0, len(bitmap), bitmap)
-        return self.communicate()
+        try:
+            status = self.communicate(sum(last - first for first, last in self.last_dirty_ranges))
+        except MatrixError:
+            if partial_timed_out:
+                # The display doesn't answer at all, so the missing answer to the partial update proves nothing
+                self.partial_updates_supported = None
+            raise
+        self.last_bitmap = bytes(bitmap)
+        self.stats['frames_sent'] += 1
+        return status
 
     def set_backlight(self, state):
         self.prepare_message(0xA1, 0x01 if state else 0x00)
         return self.communicate()
 
     def set_inverting(self, state):
+        # The display shows something else afterwards, so the next bitmap is sent in full
+        self.invalidate()
         self.prepare_message(0xA2, 0x01 if state else 0x00)
-        return self.communicate()
+        return self.communicate(self.width)
 
     def set_active(self, state):
+        self.invalidate()
         self.prepare_message(0xA3, 0x01 if state else 0x00)
-        return self.communicate()
+        return self.communicate(self.width)
 
     def set_quick_update(self, state):
         self.prepare_message(0xA4, 0x01 if state else 0x00)
         return self.communicate()
 
+class AsyncSerialBus(object):
+    """
+    Runs the transactions of all AsyncFlipdotControllers using a serial port, one at a time.
+    Status bytes don't tell which display they come from, so the displays behind a muxer share one bus:
+    a request holds the bus from writing its frame until its status byte arrives or its timeout expires,
+    and input left over from an earlier transaction is flushed before the next frame is written.
+    Use AsyncSerialBus.get() to get the bus of a serial port.
+
+    Transactions run in a thread of the bus, which reads for at most READ_TIMEOUT seconds at a time
+    until the deadline of the request, so the thread doesn't stay blocked in a read after the bus is closed.
+    """
+
+    READ_TIMEOUT = FlipdotController.READ_TIMEOUT
+    BUSES = weakref.WeakValueDictionary()
+    BUSES_LOCK = threading.Lock()
+
+    @classmethod
+    def get(cls, ser):
+        # The bus holds on to the serial port, so its ID can't be reused while the bus exists
+        with cls.BUSES_LOCK:
+            bus = cls.BUSES.get(id(ser))
+            if bus is None or bus.closed:
+                bus = cls(ser)
+                cls.BUSES[id(ser)] = bus
+            return bus
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.controllers = weakref.WeakSet()
+        self.lock = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self.closed = False
+
+    def _transact(self, frame, timeout):
+        # Runs in the thread of the bus. Any input still waiting is a late answer to a request that timed out.
+        if self.ser.timeout != self.READ_TIMEOUT:
+            self.ser.timeout = self.READ_TIMEOUT
+        self.ser.flushInput()
+        self.ser.write(frame)
+        deadline = time.monotonic() + timeout
+        status = self.ser.read(1)
+        while not status and not self.closed and time.monotonic() < deadline:
+            status = self.ser.read(1)
+        return status
+
+    async def request(self, controller, frame, timeout):
+        # Write a frame and wait up to 'timeout' seconds for its status byte
+        loop = asyncio.get_running_loop()
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.closed:
+                raise MatrixError(-3)
+            try:
+                status = await loop.run_in_executor(self.executor, self._transact, frame, timeout)
+            except (serial.SerialException, OSError):
+                raise MatrixError(-3)
+        if not status:
+            raise MatrixError(-1)
+        status = ord(status)
+        if status != 0xFF:
+            raise MatrixError(response = status)
+        return status
+
+    async def close(self):
+        self.closed = True
+        # A running transaction stops reading within READ_TIMEOUT, waiting for it leaves no thread blocked in a read
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+class AsyncFlipdotController(FlipdotController):
+    """
+    An asyncio variant of FlipdotController whose communicating methods are coroutines.
+    The serial port is used in a thread of its own, so the event loop keeps running while a request waits at most 'timeout' seconds.
+    All controllers using the same serial port share an AsyncSerialBus, which runs their transactions one at a time.
+    The bus is closed once close() has been called on every controller using it.
+    Partial updates are not supported by this variant.
+    """
+
+    def __init__(self, port, width, height = 16, using_mux = False, mux_port = 0, timeout = 5.0):
+        super().__init__(port, width, height, using_mux = using_mux, mux_port = mux_port)
+        self.timeout = timeout
+        self.bus = AsyncSerialBus.get(self.ser)
+        self.bus.controllers.add(self)
+
+    def build_frame(self):
+        # The transmit buffer is reused by the next message, so the frame is copied before the write is scheduled
+        return bytes(self.get_frame())
+
+    async def communicate(self):
+        frame = self.build_frame()
+        self.stats['transactions'] += 1
+        self.stats['bytes_sent'] += len(frame)
+        return await self.bus.request(self, frame, self.timeout)
+
+    async def send_bitmap(self, bitmap, force = False):
+        if not isinstance(bitmap, (bytes, bytearray, memoryview)):
+            bitmap = bytearray(bitmap)
+        if len(bitmap) < 2*self.width:
+            bitmap = bytes(bitmap) + bytes(2*self.width - len(bitmap))
+        if not force and self.last_bitmap == bitmap:
+            self.stats['frames_skipped'] += 1
+            self.stats['transactions_saved'] += 1
+            self.stats['bytes_saved'] += len(bitmap) + 3 + (4 if self.using_mux else 0)
+            return 0xFF
+        self.last_dirty_ranges = self.get_dirty_ranges(self.last_bitmap, bitmap)
+        self.last_bitmap = None
+        self.prepare_message(0xA0, len(bitmap), bitmap)
+        status = await self.communicate()
+        self.last_bitmap = bytes(bitmap)
+        self.stats['frames_sent'] += 1
+        return status
+
+    async def set_backlight(self, state):
+        self.prepare_message(0xA1, 0x01 if state else 0x00)
+        return await self.communicate()
+
+    async def set_inverting(self, state):
+        self.invalidate()
+        self.prepare_message(0xA2, 0x01 if state else 0x00)
+        return await self.communicate()
+
+    async def set_active(self, state):
+        self.invalidate()
+        self.prepare_message(0xA3, 0x01 if state else 0x00)
+        return await self.communicate()
+
+    async def set_quick_update(self, state):
+        self.prepare_message(0xA4, 0x01 if state else 0x00)
+        return await self.communicate()
+
+    async def close(self):
+        self.bus.controllers.discard(self)
+        if not self.bus.controllers:
+            await self.bus.close()
+
 class DummyFlipdotController(object):
     """
     A dummy class to use when you want to use FlipdotGraphics, but aren't directly connected to a flipdot controller.
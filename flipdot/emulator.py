@@ -0,0 +1,340 @@
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This file contains an emulator for the serial side of the flipdot hardware, to run the controller and the server without physical displays.
+It emulates the serial port muxer and the display controllers behind it, and is exposed as a pseudo terminal or a TCP socket.
+"""
+
+import os
+import select
+import socket
+import time
+
+from .framebuffer import *
+
+class EmulatedDisplay(object):
+    """
+    The state of a single display controller: Its framebuffer, its settings and the dots that are actually shown.
+    Like the existing firmware, it answers partial updates (0xA5) with 0xEE unless 'partial_updates' is set.
+    """
+
+    def __init__(self, width, height = 16, address = 0, partial_updates = False):
+        self.width = width
+        self.height = height
+        self.address = address
+        self.partial_updates = partial_updates
+        self.fb = Framebuffer(width, height)
+        self.shown = Framebuffer(width, height)
+        self.backlight = False
+        self.inverting = False
+        self.active = True
+        self.quick_update = True
+        self.stats = {
+            'commands': 0,
+            'errors': 0,
+            'frames': 0,
+            'partial_updates': 0,
+            'dots_flipped': 0
+        }
+
+    def update(self):
+        # Flip the dots to match the framebuffer and return how many dots were flipped
+        if not self.active:
+            return 0
+        target = self.fb.copy()
+        if self.inverting:
+            target.invert()
+        if self.quick_update:
+            # Only the dots that differ are flipped
+            changed = int.from_bytes(self.shown.data, 'big') ^ int.from_bytes(target.data, 'big')
+            flipped = bin(changed).count('1')
+        else:
+            # Every dot is flipped, whether it changes or not
+            flipped = self.width * self.height
+        self.shown = target
+        self.stats['dots_flipped'] += flipped
+        return flipped
+
+    def execute(self, message):
+        """
+        Execute a message (starting with 0xFF) and return the status byte and the number of flipped dots.
+        """
+
+        self.stats['commands'] += 1
+        if len(message) < 3 or message[0] != 0xFF:
+            return self.error()
+        command = message[1]
+        if command == 0xA0:
+            length = message[2]
+            data = message[3:]
+            if len(data) != length or length > len(self.fb.data):
+                return self.error()
+            # A short bitmap only overwrites the beginning, the rest of the display keeps its old contents
+            self.fb.data[:length] = data
+            self.stats['frames'] += 1
+            return 0xFF, self.update()
+        elif command in (0xA1, 0xA2, 0xA3, 0xA4):
+            if len(message) != 3:
+                return self.error()
+            state = bool(message[2])
+            if command == 0xA1:
+                self.backlight = state
+                return 0xFF, 0
+            elif command == 0xA2:
+                self.inverting = state
+            elif command == 0xA3:
+                self.active = state
+            else:
+                self.quick_update = state
+            return 0xFF, self.update()
+        elif command == 0xA5 and self.partial_updates:
+            if len(message) < 4:
+                return self.error()
+            start, count = message[2], message[3]
+            data = message[4:]
+            cb = self.fb.col_bytes
+            if start + count > self.width or len(data) != count * cb:
+                return self.error()
+            self.fb.data[start*cb:(start+count)*cb] = data
+            self.stats['frames'] += 1
+            self.stats['partial_updates'] += 1
+            return 0xFF, self.update()
+        return self.error()
+
+    def error(self):
+        self.stats['errors'] += 1
+        return 0xEE, 0
+
+    def render(self, on = "O", off = "."):
+        # The shown dots as text, one line per row
+        return "\n".join("".join(on if self.shown.get_pixel(x, y) else off for x in range(self.width)) for y in range(self.height))
+
+class FlipdotEmulator(object):
+    """
+    Emulates the serial port muxer with displays attached to it, or a single display if 'using_mux' is False.
+    'displays' is a display hardware configuration like the one passed to FlipdotServer.
+    Messages for addresses without a display are not answered, like on a bus with an unplugged display.
+
+    The time the bytes of a message take at 'baudrate' and the time the display takes to flip its dots
+    ('flip_latency' seconds per dot) pass before a message is acknowledged.
+    A message that isn't complete after 'message_timeout' seconds is discarded and answered with 0xE0.
+    Partial updates (0xA5) are only accepted if 'partial_updates' is set, which no existing firmware supports yet.
+    """
+
+    def __init__(self, displays, baudrate = 115200, flip_latency = 0.0, using_mux = True, partial_updates = False,
+                 message_timeout = 1.0, verbose = False):
+        self.displays = {}
+        self.names = {}
+        for name, display in displays.items():
+            self.displays[display['address']] = EmulatedDisplay(display['width'], display.get('height', 16), display['address'],
+                partial_updates = partial_updates)
+            self.names[display['address']] = name
+        if not using_mux and len(self.displays) != 1:
+            raise ValueError("Exactly one display is required without a muxer")
+        self.baudrate = baudrate
+        self.flip_latency = flip_latency
+        self.using_mux = using_mux
+        self.message_timeout = message_timeout
+        self.verbose = verbose
+        self.buffer = bytearray()
+        self.message_start = None
+        self.running = False
+        self.stats = {
+            'transactions': 0,
+            'bytes_received': 0,
+            'unanswered': 0,
+            'timeouts': 0
+        }
+
+    def output_verbose(self, text):
+        if self.verbose:
+            print(text)
+
+    def get_display(self, address = None):
+        if address is None:
+            return next(iter(self.displays.values()))
+        return self.displays.get(address)
+
+    def wire_time(self, length):
+        # 8 data bits plus start and stop bit per byte
+        return length * 10 / self.baudrate if self.baudrate else 0.0
+
+    def _next_message(self):
+        """
+        Take the next complete message from the buffer.
+        Returns the address (None without a muxer) and the message, or None if the message is still incomplete.
+        """
+
+        buf = self.buffer
+        if self.using_mux:
+            # Skip anything that isn't the start of a mux header
+            start = buf.find(0xF0)
+            if start == -1:
+                buf.clear()
+                return None
+            del buf[:start]
+            if len(buf) < 4:
+                return None
+            length = (buf[2] << 8) + buf[3]
+            if len(buf) < 4 + length:
+                return None
+            address = buf[1] - 0xC0
+            message = bytes(buf[4:4 + length])
+            del buf[:4 + length]
+            return address, message
+
+        start = buf.find(0xFF)
+        if start == -1:
+            buf.clear()
+            return None
+        del buf[:start]
+        if len(buf) < 3:
+            return None
+        command = buf[1]
+        if command == 0xA0:
+            length = 3 + buf[2]
+        elif command == 0xA5:
+            if len(buf) < 4:
+                return None
+            length = 4 + buf[3] * self.get_display().fb.col_bytes
+        else:
+            length = 3
+        if len(buf) < length:
+            return None
+        message = bytes(buf[:length])
+        del buf[:length]
+        return None, message
+
+    def feed(self, data, now = None):
+        """
+        Process received bytes. Returns a list of (status, answer_time) tuples for the messages that were completed,
+        where 'answer_time' is the time.monotonic() value at which the status byte is due.
+        """
+
+        if now is None:
+            now = time.monotonic()
+        self.stats['bytes_received'] += len(data)
+        if not self.buffer:
+            self.message_start = now
+        self.buffer += data
+        answers = []
+        while True:
+            result = self._next_message()
+            if result is None:
+                break
+            address, message = result
+            received = max(now, self.message_start + self.wire_time(len(message) + (4 if self.using_mux else 0)))
+            self.message_start = received
+            self.stats['transactions'] += 1
+            display = self.get_display(address)
+            if display is None:
+                self.stats['unanswered'] += 1
+                continue
+            status, flipped = display.execute(message)
+            self.output_verbose("{0}: Command 0x{1:02X}, {2} bytes, status 0x{3:02X}, {4} dots flipped".format(
+                self.names[display.address], message[1] if len(message) > 1 else 0, len(message), status, flipped))
+            answers.append((status, received + flipped * self.flip_latency))
+        if not self.buffer:
+            self.message_start = None
+        return answers
+
+    def check_timeout(self, now = None):
+        # Discard an incomplete message which has been waiting for too long
+        if now is None:
+            now = time.monotonic()
+        if self.message_start is None or now - self.message_start < self.message_timeout:
+            return []
+        # Only a display that has been selected by a complete mux header can notice the timeout
+        answer = not self.using_mux or (len(self.buffer) >= 4 and self.buffer[1] - 0xC0 in self.displays)
+        self.buffer.clear()
+        self.message_start = None
+        self.stats['timeouts'] += 1
+        return [(0xE0, now)] if answer else []
+
+    def serve(self, read_fd, write):
+        # Answer messages arriving on a file descriptor until stop() is called or the other side goes away
+        self.running = True
+        while self.running:
+            readable, writable, exceptional = select.select([read_fd], [], [], 0.1)
+            if readable:
+                try:
+                    data = os.read(read_fd, 4096)
+                except OSError:
+                    # The pty reports an error while no one has the other side open
+                    time.sleep(0.1)
+                    continue
+                if not data:
+                    break
+                answers = self.feed(data)
+            else:
+                answers = self.check_timeout()
+            for status, answer_time in answers:
+                delay = answer_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                write(bytes([status]))
+
+    def serve_pty(self, callback = None):
+        """
+        Create a pseudo terminal and answer messages written to it. The path of the terminal to use as serial port
+        is passed to 'callback' once it is ready.
+        """
+
+        import tty
+        master, slave = os.openpty()
+        # Raw mode, so the terminal doesn't echo or translate any bytes before a serial port is opened on it
+        tty.setraw(slave)
+        path = os.ttyname(slave)
+        self.output_verbose("Emulating displays on {0}".format(path))
+        if callback is not None:
+            callback(path)
+        try:
+            # The slave side stays open, so the terminal survives clients closing and reopening it
+            self.serve(master, lambda data: os.write(master, data))
+        finally:
+            os.close(master)
+            os.close(slave)
+
+    def serve_socket(self, port, host = 'localhost'):
+        """
+        Listen for TCP connections and answer messages sent over them, one connection at a time.
+        Use the URL socket://host:port as serial port to connect to it.
+        """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(1)
+        sock.settimeout(1.0)
+        self.output_verbose("Emulating displays on socket://{0}:{1}".format(host, port))
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    conn, addr = sock.accept()
+                except socket.timeout:
+                    continue
+                with conn:
+                    self.buffer.clear()
+                    self.message_start = None
+                    self.serve(conn.fileno(), conn.sendall)
+        finally:
+            sock.close()
+
+    def stop(self):
+        self.running = False
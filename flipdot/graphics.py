@@ -16,46 +16,69 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import datetime
+import json
 import math
 import os
 import subprocess
+import threading
 import time
-from PIL import Image, ImageDraw, ImageFont
-
-class FlipdotGraphics(object):
-    DEFAULT_FONT = "FIS_20"
-    FONT_DIR = "fonts"
-
-    def __init__(self, controller, verbose = False):
-        self.verbose = verbose
-        self.controller = controller
-        self.init_image()
-        self.font_list = {}
-        self.load_fonts()
-
-    def output_verbose(self, text):
-        if self.verbose:
-            print(text)
-
-    def get_bitmap(self):
-        return self.image_to_bitmap(self.img)
-
-    def init_image(self):
-        self.img = Image.new('L', (self.controller.width, self.controller.height), 'black')
-        self.draw = ImageDraw.Draw(self.img)
-        self.draw.fontmode = "1"
-
-    def commit(self):
-        self.controller.send_bitmap(self.get_bitmap())
-        self.init_image()
-
-    def _nice_font_name(self, name):
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+from .controller import DummyFlipdotController
+from .framebuffer import *
+from .utils import *
+
+def sprite_cost(sprite):
+    # Memory used by the framebuffers of a (value, mask) pair, for size-limited caches
+    value, mask = sprite
+    return len(value.data) + len(mask.data)
+
+class FontIndex(object):
+    """
+    An index of all available fonts, mapping normalized font names to font files.
+    It contains the TrueType fonts known to fontconfig as well as the fonts in the bundled font directory.
+    The index is built on the first lookup and persisted to a cache file, which is rebuilt
+    whenever one of the font directories or fontconfig caches has been modified.
+    """
+
+    CACHE_VERSION = 1
+    SYSTEM_FONT_DIRS = (
+        "/usr/share/fonts",
+        "/usr/local/share/fonts",
+        "~/.fonts",
+        "~/.local/share/fonts",
+        "/var/cache/fontconfig",
+        "~/.cache/fontconfig"
+    )
+
+    def __init__(self, font_dir, cache_file = None):
+        self.font_dir = font_dir
+        if cache_file is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser("~/.cache")
+            cache_file = os.path.join(cache_home, "flipdot", "font_index.json")
+        self.cache_file = cache_file
+        self.fonts = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def nice_name(name):
         name = name.lower()
         name = name.replace(",", " ")
         name = " ".join(sorted(set(name.split())))
         return name
-    
-    def load_fonts(self):
+
+    def get_signature(self):
+        # The modification times of all relevant directories, used to detect whether the cache is stale
+        signature = {}
+        for directory in self.SYSTEM_FONT_DIRS + (self.font_dir,):
+            directory = os.path.abspath(os.path.expanduser(directory))
+            try:
+                signature[directory] = os.stat(directory).st_mtime
+            except OSError:
+                pass
+        return signature
+
+    def list_system_fonts(self):
         def _parse_line(line):
             try:
                 path, name, style = [part.strip() for part in line.split(":")]
@@ -79,30 +102,312 @@ class FlipdotGraphics(object):
                 styles.append("Black")
             combined_name = name + " " + " ".join(styles)
             return (path, combined_name)
-        
-        self.output_verbose("Loading available fonts...")
-        raw_list = subprocess.check_output(("fc-list", "-f", "%{file}:%{family}:%{style}\n", ":fontformat=TrueType")).decode('utf-8')
-        font_list = dict([_parse_line(line) for line in raw_list.splitlines()])
-        for path, name in font_list.items():
+
+        try:
+            raw_list = subprocess.check_output(("fc-list", "-f", "%{file}:%{family}:%{style}\n", ":fontformat=TrueType")).decode('utf-8')
+        except (OSError, subprocess.CalledProcessError):
+            # fontconfig is not available, only the bundled fonts can be used
+            return {}
+        return dict([_parse_line(line) for line in raw_list.splitlines()])
+
+    def list_bundled_fonts(self):
+        fonts = {}
+        try:
+            filenames = sorted(os.listdir(self.font_dir))
+        except OSError:
+            return fonts
+        for filename in filenames:
+            name, ext = os.path.splitext(filename)
+            if ext.lower() in (".pil", ".ttf"):
+                fonts[os.path.join(self.font_dir, filename)] = name
+        return fonts
+
+    def build(self):
+        fonts = {}
+        for path, name in list(self.list_system_fonts().items()) + list(self.list_bundled_fonts().items()):
             if path and name:
-                _name = self._nice_font_name(name)
-                self.font_list[_name] = path
-        self.output_verbose("Found {0} fonts.".format(len(self.font_list)))
-    
+                fonts[self.nice_name(name)] = path
+        return fonts
+
+    def read_cache(self, signature):
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if cache.get('version') != self.CACHE_VERSION or cache.get('signature') != signature:
+            return None
+        return cache.get('fonts')
+
+    def write_cache(self, signature, fonts):
+        cache = {
+            'version': self.CACHE_VERSION,
+            'signature': signature,
+            'fonts': fonts
+        }
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok = True)
+            tmp_file = "{0}.{1}.tmp".format(self.cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_file, self.cache_file)
+        except (IOError, OSError):
+            # The cache is only an optimization, so a read-only home directory is no reason to fail
+            pass
+
+    def load(self, rebuild = False):
+        with self.lock:
+            if self.fonts is not None and not rebuild:
+                return
+            signature = self.get_signature()
+            fonts = None if rebuild else self.read_cache(signature)
+            if fonts is None:
+                fonts = self.build()
+                self.write_cache(signature, fonts)
+            self.fonts = fonts
+
+    def get_fonts(self):
+        if self.fonts is None:
+            self.load()
+        return self.fonts
+
     def get_font(self, query):
+        fonts = self.get_fonts()
+
         # Perform a direct lookup first
-        path = self.font_list.get(self._nice_font_name(query))
+        path = fonts.get(self.nice_name(query))
         if path:
             return path
 
         # Then check for a font called "... Regular"
-        path = self.font_list.get(self._nice_font_name(query + " Regular"))
+        path = fonts.get(self.nice_name(query + " Regular"))
         if path:
             return path
         else:
             raise ValueError("No font found for query '{0}'.".format(query))
 
+class AssetCache(object):
+    """
+    A cache for images loaded from files, holding them decoded, rotated and converted to (value, mask) framebuffer pairs.
+    Entries are keyed by path, rotation angle, dither mode and threshold and reloaded when the file has been modified.
+    To keep lookups off the disk, a file's modification time is checked at most every 'check_interval' seconds.
+    If 'check_interval' is 0 or None, lookups never touch the disk for cached images. revalidate() can then be called
+    from somewhere else, e.g. a background thread, to reload the images whose files have been modified.
+    """
+
+    IMAGE_EXTENSIONS = (".png", ".gif", ".bmp", ".jpg", ".jpeg")
+
+    def __init__(self, maxsize = 256, check_interval = 5.0):
+        self.check_interval = check_interval
+        self.cache = LRUCache(maxsize = maxsize)
+
+    def _get_mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def load(self, path, angle = 0, dither = 'threshold', threshold = 127):
+        img = Image.open(path).convert('RGBA')
+        if angle:
+            img = img.rotate(angle, expand = True)
+        return Framebuffer.from_image_with_mask(img, dither, threshold)
+
+    def get(self, path, angle = 0, dither = 'threshold', threshold = 127):
+        # The returned framebuffers are shared and must not be modified
+        key = (os.path.abspath(path), angle, dither, threshold)
+        now = time.time()
+        entry = self.cache.get(key)
+        if entry is not None:
+            sprite, mtime, last_checked = entry
+            if not self.check_interval or now - last_checked < self.check_interval:
+                return sprite
+            if self._get_mtime(path) == mtime:
+                entry[2] = now
+                return sprite
+        mtime = self._get_mtime(path)
+        sprite = self.load(path, angle, dither, threshold)
+        self.cache.put(key, [sprite, mtime, now])
+        return sprite
+
+    def revalidate(self):
+        # Reload the cached images whose files have been modified and drop those whose files are gone.
+        # Returns the number of images that changed.
+        with self.cache.lock:
+            entries = list(self.cache.entries.items())
+        count = 0
+        for key, entry in entries:
+            sprite, mtime, last_checked = entry
+            now = time.time()
+            new_mtime = self._get_mtime(key[0])
+            if new_mtime == mtime:
+                entry[2] = now
+                continue
+            try:
+                self.cache.put(key, [self.load(*key), new_mtime, now])
+            except (IOError, OSError):
+                self.cache.pop(key)
+            count += 1
+        return count
+
+    def preload(self, directory, angles = (0,), dither = 'threshold', threshold = 127):
+        # Load all images below the given directory, returns the number of images loaded
+        count = 0
+        for root, dirs, files in os.walk(directory):
+            for filename in sorted(files):
+                if not filename.lower().endswith(self.IMAGE_EXTENSIONS):
+                    continue
+                for angle in angles:
+                    try:
+                        self.get(os.path.join(root, filename), angle, dither, threshold)
+                    except (IOError, OSError):
+                        continue
+                    count += 1
+        return count
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+class Marquee(object):
+    """
+    Text scrolling through the display from right to left.
+    The text is rendered once into a strip of packed columns, followed by 'gap' blank columns before it repeats.
+    Every display window is then just a slice of that strip.
+    """
+
+    def __init__(self, value, mask, display_width, speed = 20.0, gap = None):
+        self.display_width = display_width
+        self.speed = speed
+        gap = display_width if gap is None else gap
+        self.period = value.width + gap
+        # Repeat the start of the strip at its end, so windows wrapping around the end can be sliced as well
+        self.value = self._build_strip(value, gap)
+        self.mask = self._build_strip(mask, gap)
+
+    def _build_strip(self, fb, gap):
+        cycle = fb.data + bytearray(gap * fb.col_bytes)
+        repeats = 1 + -(-self.display_width // self.period)
+        return Framebuffer(self.period + self.display_width, fb.height, cycle * repeats)
+
+    def window(self, offset):
+        offset %= self.period
+        return self.value[offset:offset + self.display_width], self.mask[offset:offset + self.display_width]
+
+    def offset_at(self, timestamp):
+        # Offset for a point in time, so independent renderers show the same position
+        return int(timestamp * self.speed) % self.period
+
+    def frames(self, loops = None):
+        """
+        Generate the display windows one pixel apart, paced to the scrolling speed.
+        The time the consumer spends between frames (e.g. sending them) is compensated,
+        and positions are skipped if the consumer falls behind.
+        """
+
+        step = 1.0 / self.speed
+        deadline = time.monotonic()
+        position = 0
+        while loops is None or position < loops * self.period:
+            yield self.window(position)
+            deadline += step
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+                position += 1
+            else:
+                missed = int(-delay / step)
+                deadline += missed * step
+                position += 1 + missed
+
+class FlipdotGraphics(object):
+    DEFAULT_FONT = "FIS_20"
+    FONT_DIR = "fonts"
+    FONT_INDEX = FontIndex(FONT_DIR)
+    FONT_CACHE = LRUCache(maxsize = 64)
+    ASSET_CACHE = AssetCache()
+    # Enough for every frame of a binary and an analog clock in two sizes each
+    WIDGET_CACHE = LRUCache(maxsize = 4320)
+    # Marquees with changing text would push out the clock frames, so they are kept apart
+    MARQUEE_CACHE = LRUCache(maxsize = 16)
+    # Rendered text is cached as converted sprites, up to 1 MB of framebuffer data
+    TEXT_CACHE = LRUCache(maxsize = 512, maxcost = 1024*1024, sizeof = sprite_cost)
+
+    def __init__(self, controller, verbose = False):
+        self.verbose = verbose
+        self.controller = controller
+        self.init_image()
+
+    def output_verbose(self, text):
+        if self.verbose:
+            print(text)
+
+    def get_bitmap(self):
+        return list(self.fb.data)
+
+    def get_framebuffer(self):
+        return self.fb.copy()
+
+    @property
+    def img(self):
+        # The canvas as a PIL image, e.g. for previews. Drawing on it has no effect.
+        return self.fb.to_image()
+
+    def get_layer(self):
+        # The canvas along with the mask of all pixels drawn since init_image, for compositing it later
+        return (self.fb.copy(), self.coverage.copy())
+
+    def paste_layer(self, layer):
+        fb, coverage = layer
+        self.paste(fb, 0, 0, coverage)
+
+    def init_image(self):
+        self.fb = Framebuffer(self.controller.width, self.controller.height)
+        self.coverage = Framebuffer(self.controller.width, self.controller.height)
+
+    def paste(self, fb, x = 0, y = 0, mask = None):
+        # Copy the pixels of a framebuffer that are set in the mask onto the canvas
+        if mask is None:
+            mask = Framebuffer(fb.width, fb.height)
+            mask.fill(True)
+        self.fb.blit(fb, x, y, mask = mask)
+        self.coverage.blit(mask, x, y, op = 'or')
+
+    def commit(self):
+        self.controller.send_bitmap(self.fb.data)
+        self.init_image()
+
+    @property
+    def font_list(self):
+        return self.FONT_INDEX.get_fonts()
+
+    def _nice_font_name(self, name):
+        return self.FONT_INDEX.nice_name(name)
+
+    def load_fonts(self):
+        # Force a rebuild of the shared font index, e.g. after installing new fonts
+        self.output_verbose("Loading available fonts...")
+        self.FONT_INDEX.load(rebuild = True)
+        # Loaded fonts, fonts that weren't found before and text rendered with them may be outdated now
+        self.FONT_CACHE.clear()
+        self.TEXT_CACHE.clear()
+        self.MARQUEE_CACHE.clear()
+        self.output_verbose("Found {0} fonts.".format(len(self.font_list)))
+
+    def get_font(self, query):
+        return self.FONT_INDEX.get_font(query)
+
     def get_imagefont(self, font, size = None):
+        # Fonts that couldn't be found are cached as None so repeated lookups of a wrong name fail fast
+        key = (self.FONT_DIR, font, size)
+        result = self.FONT_CACHE.get_or_create(key, lambda: self._load_imagefont(font, size))
+        if result is None:
+            raise ValueError("No font found for query '{0}'.".format(font))
+        return result
+
+    def _load_imagefont(self, font, size):
         try:
             # font parameter as ttf filename
             return ImageFont.truetype(font, size), True
@@ -129,67 +434,55 @@ class FlipdotGraphics(object):
 
         try:
             # font parameter as font name
-            return ImageFont.truetype(self.get_font(font), size), True
+            path = self.get_font(font)
+            if path.endswith(".pil"):
+                return ImageFont.load(path), False
+            return ImageFont.truetype(path, size), True
         except (OSError, ValueError):
             pass
 
-        raise ValueError("No font found for query '{0}'.".format(font))
+        return None
 
-    def image_to_bitmap(self, image):
+    def image_to_bitmap(self, image, dither = 'threshold', threshold = 127):
         if isinstance(image, Image.Image):
             img = image.convert('L')
         else:
             img = Image.open(image).convert('L')
-        pixels = img.load()
         width, height = img.size
-        bitmap = []
-        for x in range(width):
-            col_byte = 0x00
-            for y in range(height):
-                if pixels[x, y] > 127:
-                    col_byte += 1 << (8 - y%8 - 1)
-                if (y+1) % 8 == 0:
-                    bitmap.append(col_byte)
-                    col_byte = 0x00
-        return bitmap
-
-    def bitmap_to_image(self, bitmap):
-        # Convert a bitmap in the format used for serial communication to an image. This is needed as an intermediate step when using the server system
-        width = round(len(bitmap)/2)
-        height = self.controller.height
-        img = Image.new('L', (width, height), 'black')
-        pixels = img.load()
-        for index, col_byte in enumerate(bitmap):
-            x = int(index/2)
-            for byte_pos in range(8):
-                y = byte_pos + 8*(index%2)
-                pixels[x, y] = 255 * (col_byte & (1 << (7-byte_pos)))
-        return img
-
-    def get_bitmap(self):
-        return self.image_to_bitmap(self.img)
-
-    def init_image(self):
-        self.img = Image.new('L', (self.controller.width, self.controller.height), 'black')
-        self.draw = ImageDraw.Draw(self.img)
-        self.draw.fontmode = "1"
-
-    def commit(self):
-        self.controller.send_bitmap(self.get_bitmap())
-        self.init_image()
+        # Only complete bytes are sent for each column, so any rows below the last full byte are dropped
+        if height % 8:
+            height -= height % 8
+            img = img.crop((0, 0, width, height))
+        return list(Framebuffer.from_image(img, dither, threshold).data)
 
-    def bitmap(self, image, halign = None, valign = None, left = None, center = None, right = None, top = None, middle = None, bottom = None, angle = 0):
+    def bitmap_to_image(self, bitmap, width = None, height = None, mode = 'L'):
+        # Convert a bitmap in the format used for serial communication to an image. This is needed as an intermediate step when using the server system
+        if height is None:
+            height = self.controller.height
+        if width is None:
+            width = -(-len(bitmap) // ((height + 7) // 8))
+        return Framebuffer(width, height, bitmap).to_image(mode)
+
+    def bitmap(self, image, halign = None, valign = None, left = None, center = None, right = None, top = None, middle = None, bottom = None, angle = 0, dither = 'threshold', threshold = 127):
+        # 'dither' selects how grayscale images are converted, see binarize() for the available modes
+        if isinstance(image, str):
+            # Image files are decoded, rotated and converted only once and then shared through the asset cache
+            value, mask = self.ASSET_CACHE.get(image, angle, dither, threshold)
+        else:
+            if isinstance(image, Image.Image):
+                img = image
+            else:
+                img = Image.open(image).convert('RGBA')
+            if angle:
+                img = img.rotate(angle, expand = True)
+            value, mask = Framebuffer.from_image_with_mask(img, dither, threshold)
+        self.sprite(value, mask, halign, valign, left, center, right, top, middle, bottom)
+
+    def sprite(self, value, mask = None, halign = None, valign = None, left = None, center = None, right = None, top = None, middle = None, bottom = None):
+        # Paste an already converted framebuffer, positioned the same way as with bitmap()
         halign = halign or 'center'
         valign = valign or 'middle'
-        if isinstance(image, Image.Image):
-            img = image
-        else:
-            img = Image.open(image).convert('RGBA')
-
-        if angle:
-            img = img.rotate(angle, expand = True)
-
-        bwidth, bheight = img.size
+        bwidth, bheight = value.width, value.height
 
         if left is not None:
             bitmapx = left
@@ -219,13 +512,27 @@ class FlipdotGraphics(object):
             else:
                 bitmapy = 0
 
-        self.img.paste(img, (bitmapx, bitmapy), img)
+        self.paste(value, bitmapx, bitmapy, mask)
+
+    def get_text_image(self, text, font = None, size = 20, color = 'white'):
+        return self._render_text(text, font or self.DEFAULT_FONT, size, color)
 
-    def text(self, text, font = None, size = 20, color = 'white', timestring = False, **kwargs):
+    def get_text_sprite(self, text, font = None, size = 20, color = 'white', angle = 0, dither = 'threshold', threshold = 127):
+        # Rendered and converted text is shared through the text cache, so the framebuffers must not be modified
         font = font or self.DEFAULT_FONT
-        if timestring:
-            text = time.strftime(text)
+        if isinstance(color, list):
+            # Colors may arrive as JSON lists, which can't be used in a cache key
+            color = tuple(color)
+        key = (self.FONT_DIR, 'text', text, font, size, color, angle, dither, threshold)
+        return self.TEXT_CACHE.get_or_create(key, lambda: self._image_to_sprite(
+            self._render_text(text, font, size, color), angle, dither, threshold))
+
+    def _image_to_sprite(self, img, angle, dither, threshold):
+        if angle:
+            img = img.rotate(angle, expand = True)
+        return Framebuffer.from_image_with_mask(img, dither, threshold)
 
+    def _render_text(self, text, font, size, color):
         textfont, truetype = self.get_imagefont(font, size)
         approx_tsize = textfont.getsize(text)
         text_img = Image.new('RGBA', approx_tsize, (0, 0, 0, 0))
@@ -239,13 +546,27 @@ class FlipdotGraphics(object):
             # only crop horizontally with pixel fonts
             bbox = text_img.getbbox()
             text_img = text_img.crop((bbox[0], 0, bbox[2], text_img.size[1]))
-        self.bitmap(text_img, **kwargs)
+        return text_img
 
-    def vertical_text(self, text, font = None, size = 20, char_align = 'center', spacing = 2, color = 'white', timestring = False, **kwargs):
-        font = font or self.DEFAULT_FONT
+    def text(self, text, font = None, size = 20, color = 'white', timestring = False, angle = 0, dither = 'threshold', threshold = 127, **kwargs):
+        # The keyword arguments position the text, see sprite()
         if timestring:
             text = time.strftime(text)
+        self.sprite(*self.get_text_sprite(text, font, size, color, angle, dither, threshold), **kwargs)
 
+    def get_vertical_text_image(self, text, font = None, size = 20, char_align = 'center', spacing = 2, color = 'white'):
+        return self._render_vertical_text(text, font or self.DEFAULT_FONT, size, char_align, spacing, color)
+
+    def get_vertical_text_sprite(self, text, font = None, size = 20, char_align = 'center', spacing = 2, color = 'white',
+                                 angle = 0, dither = 'threshold', threshold = 127):
+        font = font or self.DEFAULT_FONT
+        if isinstance(color, list):
+            color = tuple(color)
+        key = (self.FONT_DIR, 'vertical_text', text, font, size, char_align, spacing, color, angle, dither, threshold)
+        return self.TEXT_CACHE.get_or_create(key, lambda: self._image_to_sprite(
+            self._render_vertical_text(text, font, size, char_align, spacing, color), angle, dither, threshold))
+
+    def _render_vertical_text(self, text, font, size, char_align, spacing, color):
         textfont, truetype = self.get_imagefont(font, size)
         char_imgs = []
         for char in text:
@@ -284,22 +605,80 @@ class FlipdotGraphics(object):
 
             text_img.paste(char_img, (xpos, ypos), char_img)
             xpos += cwidth + spacing
-        self.bitmap(text_img, **kwargs)
+        return text_img
+
+    def vertical_text(self, text, font = None, size = 20, char_align = 'center', spacing = 2, color = 'white', timestring = False,
+                      angle = 0, dither = 'threshold', threshold = 127, **kwargs):
+        if timestring:
+            text = time.strftime(text)
+        self.sprite(*self.get_vertical_text_sprite(text, font, size, char_align, spacing, color, angle, dither, threshold), **kwargs)
+
+    def _get_color_value(self, color):
+        # Whether drawing in this color sets pixels, using the same threshold as the final bitmap
+        if isinstance(color, int):
+            value = color
+        elif isinstance(color, (list, tuple)):
+            value = color[0] if len(color) < 3 else (color[0]*299 + color[1]*587 + color[2]*114) // 1000
+        else:
+            value = ImageColor.getcolor(color, 'L')
+        return value > 127
+
+    def _draw_shape(self, color, draw_func):
+        # Shapes are drawn onto a 1-bit mask with PIL, which is then filled with the color on the canvas
+        mask_img = Image.new('1', (self.controller.width, self.controller.height), 0)
+        draw_func(ImageDraw.Draw(mask_img))
+        mask = Framebuffer.from_image(mask_img)
+        if self._get_color_value(color):
+            self.paste(mask, mask = mask)
+        else:
+            self.paste(Framebuffer(mask.width, mask.height), mask = mask)
+
+    def get_marquee(self, text, font = None, size = 20, color = 'white', speed = 20.0, gap = None, **kwargs):
+        font = font or self.DEFAULT_FONT
+        if isinstance(color, list):
+            color = tuple(color)
+        key = ('marquee', self.controller.width, self.controller.height, text, font, size, color, speed, gap, tuple(sorted(kwargs.items())))
+        return self.MARQUEE_CACHE.get_or_create(key, lambda: self._build_marquee(text, font, size, color, speed, gap, **kwargs))
+
+    def _build_marquee(self, text, font, size, color, speed, gap, **kwargs):
+        # Render the text onto a canvas as wide as the text to position it vertically, using the keyword arguments of bitmap()
+        text_img = self.get_text_image(text, font, size, color)
+        graphics = FlipdotGraphics(DummyFlipdotController(text_img.size[0], self.controller.height))
+        graphics.bitmap(text_img, left = 0, **kwargs)
+        value, mask = graphics.get_layer()
+        return Marquee(value, mask, self.controller.width, speed, gap)
+
+    def marquee(self, text, font = None, size = 20, color = 'white', speed = 20.0, gap = None, timestring = False, **kwargs):
+        """
+        Scrolling text, moving by 'speed' pixels per second. The position is derived from the current time,
+        so the submessage only needs to be refreshed often enough, e.g. with a refresh_interval of 1/speed.
+        """
+
+        if timestring:
+            text = time.strftime(text)
+        marquee = self.get_marquee(text, font, size, color, speed, gap, **kwargs)
+        value, mask = marquee.window(marquee.offset_at(time.time()))
+        self.paste(value, 0, 0, mask)
 
     def line(self, points, color = 'white', width = 1):
-        self.draw.line(points, fill = color, width = width)
+        self._draw_shape(color, lambda draw: draw.line(points, fill = 1, width = width))
 
     def rectangle(self, points, color = 'white', fill = False):
-        self.draw.rectangle(points, fill = color if fill else None, outline = color)
+        self._draw_shape(color, lambda draw: draw.rectangle(points, fill = 1 if fill else None, outline = 1))
 
-    def binary_clock(self, block_width = 3, block_height = 3, block_spacing_x = 1, block_spacing_y = 1, **kwargs):
+    def get_binary_clock_sprite(self, hour, minute, block_width = 3, block_height = 3, block_spacing_x = 1, block_spacing_y = 1):
+        # Clock frames are cached by geometry and time, since there are only 1440 of them
+        key = ('binary_clock', block_width, block_height, block_spacing_x, block_spacing_y, hour, minute)
+        return self.WIDGET_CACHE.get_or_create(key, lambda: Framebuffer.from_image_with_mask(
+            self._render_binary_clock(hour, minute, block_width, block_height, block_spacing_x, block_spacing_y)))
+
+    def _render_binary_clock(self, hour, minute, block_width, block_height, block_spacing_x, block_spacing_y):
         width = 6*block_width + 5*block_spacing_x
         height = 2*block_height + block_spacing_y
         img = Image.new('RGBA', (width, height), 'black')
         draw = ImageDraw.Draw(img)
-        now = datetime.datetime.now()
-        hour_bits = [now.hour >> i & 1 for i in range(7, -1, -1)][-6:]
-        minute_bits = [now.minute >> i & 1 for i in range(7, -1, -1)][-6:]
+        hour_bits = [hour >> i & 1 for i in range(7, -1, -1)][-6:]
+        minute_bits = [minute >> i & 1 for i in range(7, -1, -1)][-6:]
         
         y = 0
         for pos, bit in enumerate(hour_bits):
@@ -311,9 +690,19 @@ class FlipdotGraphics(object):
             x = pos * (block_width + block_spacing_x)
             draw.rectangle((x, y, x + block_width-1, y + block_height-1), outline = 'white', fill = 'white' if bit else 'black')
 
-        self.bitmap(img, **kwargs)
+        return img
 
-    def analog_clock(self, width = 16, height = 16, **kwargs):
+    def binary_clock(self, block_width = 3, block_height = 3, block_spacing_x = 1, block_spacing_y = 1, **kwargs):
+        now = datetime.datetime.now()
+        self.sprite(*self.get_binary_clock_sprite(now.hour, now.minute, block_width, block_height, block_spacing_x, block_spacing_y), **kwargs)
+
+    def get_analog_clock_sprite(self, hour, minute, width = 16, height = 16):
+        # The hands look the same for both halves of the day, which leaves 720 frames per size
+        key = ('analog_clock', width, height, hour % 12, minute)
+        return self.WIDGET_CACHE.get_or_create(key, lambda: Framebuffer.from_image_with_mask(
+            self._render_analog_clock(hour % 12, minute, width, height)))
+
+    def _render_analog_clock(self, hour, minute, width, height):
         def rect(r, theta):
             x = r * math.cos(math.radians(theta))
             y = r * math.sin(math.radians(theta))
@@ -325,21 +714,32 @@ class FlipdotGraphics(object):
 
         img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
         draw = ImageDraw.Draw(img)
-        now = datetime.datetime.now()
         draw.rectangle((0, 0, width-1, height-1), outline = 'white')
         center = (width/2, height/2)
 
-        hour_angle = (now.hour % 12) * 360/12 + now.minute * 360/(12*60) - 90
+        hour_angle = (hour % 12) * 360/12 + minute * 360/(12*60) - 90
         hour_length = ellipse_radius(width/2, height/2, hour_angle) * 0.3
         hour_hand = rect(hour_length, hour_angle)
         draw.line((center, (hour_hand[0]+center[0], hour_hand[1]+center[1])), fill = 'white')
 
-        minute_angle = now.minute * 360/60 - 90
+        minute_angle = minute * 360/60 - 90
         minute_length = ellipse_radius(width/2, height/2, minute_angle) * 0.8
         minute_hand = rect(minute_length, minute_angle)
         draw.line((center, (minute_hand[0]+center[0], minute_hand[1]+center[1])), fill = 'white')
 
-        self.bitmap(img, **kwargs)
+        return img
+
+    def analog_clock(self, width = 16, height = 16, **kwargs):
+        now = datetime.datetime.now()
+        self.sprite(*self.get_analog_clock_sprite(now.hour, now.minute, width, height), **kwargs)
+
+    def precompute_clock(self, widget, **params):
+        # Render all frames of a clock widget in advance, e.g. precompute_clock('analog_clock', width = 16, height = 16)
+        hours = 12 if widget == 'analog_clock' else 24
+        get_sprite = getattr(self, "get_{0}_sprite".format(widget))
+        for hour in range(hours):
+            for minute in range(60):
+                get_sprite(hour, minute, **params)
 
     def black(self):
         img = Image.new('RGBA', (self.controller.width, self.controller.height), (0, 0, 0, 0))
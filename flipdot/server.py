@@ -19,11 +19,22 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 This file contains the classes needed to operate a server which controls multiple flipdot displays.
 The server operates on a simple JSON-based protocol. The full protocol specification can be found
 in the SERVER_PROTOCOL.md file.
-The server runs as two threads; one to listen for messages and one to control the displays.
+The server runs a thread to control the displays and a thread to listen for connections,
+which are handled by a pool of worker threads.
 """
 
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import inspect
 import json
+import os
+import queue
+import selectors
 import socket
+import struct
 import threading
 import traceback
 
@@ -31,27 +42,115 @@ from .controller import *
 from .graphics import *
 from .utils import *
 
-def receive_message(sock):
-    # Receive and parse an incoming message (prefixed with its length)
-    try:
-        length = int(sock.recv(5))
-        raw_data = bytearray()
-        l = 0
-        while l < length:
-            part_data = sock.recv(4096)
-            raw_data += part_data
-            l += len(part_data)
-        message = json.loads(raw_data.decode('utf-8'))
-    except:
-        raise
+def _recv_before(sock, size, deadline):
+    # Receive up to 'size' bytes, raising socket.timeout if the deadline (a time.monotonic() value) has passed
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("Deadline exceeded")
+        sock.settimeout(remaining)
+    data = sock.recv(size)
+    if not data:
+        raise ConnectionError("Connection closed while receiving a message")
+    return data
+
+# Messages are framed in one of two ways:
+# Version 1 prefixes the JSON data with its length as five decimal digits, which limits messages to 99999 bytes.
+# Version 2 starts with FRAME_MAGIC, which can't be mistaken for a digit, the version byte and the length as a 32 bit big endian integer.
+# Replies use the framing of the message they answer, so clients that only know version 1 keep working.
+PROTOCOL_VERSIONS = (1, 2)
+# Version 1 only exists without a header, so the versions a header can declare start at 2
+FRAMED_VERSIONS = tuple(version for version in PROTOCOL_VERSIONS if version >= 2)
+FRAME_MAGIC = 0xFD
+FRAME_HEADER = struct.Struct(">BBI")
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+BITMAP_ENCODINGS = ('list', 'base64')
+
+def encode_message(data, version = 1):
+    # Build a message (prefixed with its length) in the given framing version
+    if version == 1:
+        raw_data = json.dumps(data).encode('utf-8')
+        if len(raw_data) > 99999:
+            raise ValueError("Message of {0} bytes is too long for protocol version 1".format(len(raw_data)))
+        return "{0:05d}".format(len(raw_data)).encode('ascii') + raw_data
+    elif version == 2:
+        raw_data = json.dumps(data, separators = (',', ':')).encode('utf-8')
+        if len(raw_data) > MAX_MESSAGE_SIZE:
+            raise ValueError("Message of {0} bytes exceeds the maximum of {1} bytes".format(len(raw_data), MAX_MESSAGE_SIZE))
+        return FRAME_HEADER.pack(FRAME_MAGIC, version, len(raw_data)) + raw_data
+    raise ValueError("Unsupported protocol version: {0}".format(version))
+
+def decode_message(raw_message):
+    # Parse a complete message, returns the data and the framing version
+    if raw_message[0] == FRAME_MAGIC:
+        magic, version, length = FRAME_HEADER.unpack_from(raw_message)
+        if version not in FRAMED_VERSIONS:
+            raise ValueError("Unsupported protocol version: {0}".format(version))
+        header_length = FRAME_HEADER.size
+    else:
+        version, length, header_length = 1, int(raw_message[:5]), 5
+    if len(raw_message) != header_length + length:
+        raise ValueError("Message length doesn't match its header")
+    return json.loads(bytes(raw_message[header_length:]).decode('utf-8')), version
+
+def encode_bitmap(bitmap, encoding = 'base64'):
+    if encoding == 'base64':
+        return base64.b64encode(bytes(bitmap)).decode('ascii')
+    return list(bitmap)
+
+def decode_bitmap(bitmap):
+    # Bitmaps are either lists of column bytes or base64 strings
+    if isinstance(bitmap, str):
+        return base64.b64decode(bitmap)
+    return bitmap
+
+class MessageReader(object):
+    """
+    Reads messages of either framing version from a socket.
+    If 'buffered' is set, data is received in large chunks and anything beyond the current message is kept for the next one;
+    'pending' tells whether a complete or partial message is waiting in the buffer. Otherwise, exactly one message is read.
+    """
+
+    def __init__(self, sock, buffered = True):
+        self.sock = sock
+        self.buffered = buffered
+        self.buffer = bytearray()
+
+    @property
+    def pending(self):
+        return bool(self.buffer)
+
+    def read_exactly(self, size, deadline = None):
+        while len(self.buffer) < size:
+            self.buffer += _recv_before(self.sock, 65536 if self.buffered else size - len(self.buffer), deadline)
+        data = self.buffer[:size]
+        del self.buffer[:size]
+        return data
+
+    def receive(self, deadline = None):
+        # Receive and parse the next message, returns the data and the framing version
+        header = self.read_exactly(1, deadline)
+        if header[0] == FRAME_MAGIC:
+            header += self.read_exactly(FRAME_HEADER.size - 1, deadline)
+            magic, version, length = FRAME_HEADER.unpack(header)
+            if version not in FRAMED_VERSIONS:
+                raise ValueError("Unsupported protocol version: {0}".format(version))
+            if length > MAX_MESSAGE_SIZE:
+                raise ValueError("Message of {0} bytes exceeds the maximum of {1} bytes".format(length, MAX_MESSAGE_SIZE))
+        else:
+            header += self.read_exactly(4, deadline)
+            version, length = 1, int(header)
+        raw_data = self.read_exactly(length, deadline)
+        return json.loads(raw_data.decode('utf-8')), version
+
+def receive_message(sock, deadline = None):
+    # Receive and parse an incoming message, optionally within a deadline
+    message, version = MessageReader(sock, buffered = False).receive(deadline)
     return message
 
-def send_message(sock, data):
+def send_message(sock, data, version = 1):
     # Build and send a message (prefixed with its length)
-    raw_data = json.dumps(data)
-    length = len(raw_data)
-    message = "{0:05d}{1}".format(length, raw_data)
-    sock.sendall(message.encode('utf-8'))
+    sock.sendall(encode_message(data, version))
 
 def discard_message(sock):
     sock.setblocking(False)
@@ -63,6 +162,42 @@ def discard_message(sock):
     finally:
         sock.setblocking(True)
 
+class Subscription(object):
+    """
+    The frames waiting to be pushed to a subscribed client. It holds at most one frame per display:
+    a newer frame replaces the one still waiting, so a slow client skips frames instead of holding up the control loop.
+    """
+
+    def __init__(self, conn, addr, displays, encoding, version):
+        self.conn = conn
+        self.addr = addr
+        self.displays = displays
+        self.encoding = encoding
+        self.version = version
+        self.frames = {}
+        # The number of frames skipped so far for every display
+        self.dropped = collections.Counter()
+        self.condition = threading.Condition()
+
+    def put(self, display, sequence, data):
+        with self.condition:
+            if display in self.frames:
+                self.dropped[display] += 1
+            # Replacing a waiting frame keeps its place, so displays that change often don't hold back the others
+            self.frames[display] = (sequence, data)
+            self.condition.notify()
+
+    def get(self, timeout = None):
+        # Returns the next display, sequence number and bitmap, or None if there was none within 'timeout' seconds
+        with self.condition:
+            if not self.frames:
+                self.condition.wait(timeout)
+            if not self.frames:
+                return None
+            display = next(iter(self.frames))
+            sequence, data = self.frames.pop(display)
+            return display, sequence, data
+
 class FlipdotServer(object):
     """
     One serial port for all displays, display selection via multiplexing, adress set by DTR and RTS lines.
@@ -82,15 +217,67 @@ class FlipdotServer(object):
            'address': 1
         }
     }
+
+    Changes are handed from the threads receiving messages to the control loop through a queue of commands.
+    'config' and 'current_message' hold the state requested by the clients and are only used by the receiving threads,
+    the control loop applies the commands to its own copy in 'update_data' in the order they were received.
+
+    The configuration and the current messages are saved to CONFIG_FILE in the background, at most 'save_delay' seconds
+    after a change, so changes arriving within that window are written together.
+
+    The bitmaps in ASSET_DIR are loaded at start. Rendering never checks their files, instead a background thread
+    reloads the ones that have been modified every 'asset_check_interval' seconds. If it is 0 or None, they are never reloaded.
+
+    Connections are handled by a pool of 'workers' threads. At most 'max_connections' connections are accepted
+    at the same time, further ones are answered with an error, and 'backlog' connections can wait to be accepted.
+    Once a client starts sending a message, it has to complete it within 'client_timeout' seconds.
+    Connections stay open after a reply, so clients can send further messages on them. Idle connections are watched
+    by the listener thread instead of occupying a worker, and are closed after 'keepalive_timeout' seconds.
+
+    A connection that sends a subscribe message is handed to a thread of its own, which pushes every new bitmap
+    of the subscribed displays to the client. A client that doesn't read them for 'client_timeout' seconds is disconnected.
+
+    The configuration, message and bitmap of every display have a version which increases with every change.
+    Versions start at the time the server was started in milliseconds, so they keep increasing across restarts.
+    The last FRAME_HISTORY bitmaps are kept, so clients can ask for the columns that changed since one of them.
     """
 
     CONFIG_FILE = ".server_config"
+    ASSET_DIR = "bitmaps"
+    ERROR_RETRY_INTERVAL = 5.0
+    FRAME_HISTORY = 16
+    # Graphics functions passing their remaining keyword arguments on, with the function receiving them
+    # and the arguments that function already gets from them
+    GRAPHICS_FORWARDED_PARAMS = {
+        'text': ('sprite', ('value', 'mask')),
+        'vertical_text': ('sprite', ('value', 'mask')),
+        'marquee': ('bitmap', ('image', 'left')),
+        'binary_clock': ('sprite', ('value', 'mask')),
+        'analog_clock': ('sprite', ('value', 'mask'))
+    }
 
-    def __init__(self, serial_port, display_hwconfig, port = 1820, allowed_ip_match = None, verbose = True):
+    def __init__(self, serial_port, display_hwconfig, port = 1820, allowed_ip_match = None, verbose = True,
+                 workers = 8, max_connections = 32, backlog = 16, client_timeout = 5.0, keepalive_timeout = 60.0, save_delay = 5.0,
+                 asset_check_interval = 5.0):
         self.running = False
         self.port = port
         self.allowed_ip_match = allowed_ip_match
         self.verbose = verbose
+        self.workers = workers
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.client_timeout = client_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.connection_count = 0
+        self.idle_connections = queue.Queue()
+        self.connection_lock = threading.Lock()
+        self.config_lock = threading.Lock()
+        self.save_delay = save_delay
+        self.asset_check_interval = asset_check_interval
+        self.save_pending = False
+        self.saved_hash = None
+        self.replaying = False
+        self.persist_condition = threading.Condition()
         self.ser = get_serial_port(serial_port)
         self.ser.flushInput() # To remove random data generated by turning the power off
         self.displays = {}
@@ -99,8 +286,25 @@ class FlipdotServer(object):
         self.current_message = {}
         self.current_bitmap = {}
         self.display_hwconfig = display_hwconfig
+        # Signatures of the graphics functions, to check the parameters of graphics submessages
+        self.graphics_signatures = {}
+        # Guards 'config', 'current_message' and 'versions' between the threads receiving messages, the control loop doesn't use it
+        self.state_lock = threading.Lock()
+        self.versions = {}
+        version_base = int(time.time() * 1000)
+        # Commands for the control loop, which waits for 'wakeup' until the earliest deadline or until a command arrives
+        self.commands = collections.deque()
+        self.wakeup = threading.Event()
+        self.deadlines = []
+        self.next_update = {}
+        # The latest bitmaps of every display with their versions, guarded by 'subscription_lock'.
+        # The control loop adds new bitmaps and pushes them to the subscriptions.
+        self.frames = {}
+        self.subscriptions = set()
+        self.subscription_lock = threading.Lock()
         for id, display in display_hwconfig.items():
-            controller = FlipdotController(self.ser, display['width'], display['height'], using_mux = True, mux_port = display['address'])
+            controller = FlipdotController(self.ser, display['width'], display['height'], using_mux = True, mux_port = display['address'],
+                partial_updates = display.get('partial_updates', False))
             self.displays[id] = {
                 'address': display['address'],
                 'controller': controller,
@@ -113,19 +317,31 @@ class FlipdotServer(object):
                 'quick_update': True
             }
             self.update_data[id] = {
+                'config': dict(self.config[id]),
+                'message': None,
                 'config_keys_changed': [],
                 'message_changed': False,
                 'sequence_cur_pos': None,
                 'sequence_last_switched': None,
-                'dynamic_submessages': {}
+                'dynamic_submessages': {},
+                'layers': [],
+                'commit_pending': False,
+                'retry_now': False
             }
             self.current_message[id] = None
             self.current_bitmap[id] = None
+            self.versions[id] = {
+                'config': version_base,
+                'message': version_base
+            }
+            self.frames[id] = collections.deque([(version_base, None)], maxlen = self.FRAME_HISTORY)
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Prevent having to wait between reconnects
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.listener_thread = threading.Thread(target = self.network_listen)
+        self.persister_thread = threading.Thread(target = self.persist_loop)
+        self.asset_thread = threading.Thread(target = self.asset_loop, daemon = True)
 
     def output_verbose(self, text):
         if self.verbose:
@@ -133,22 +349,90 @@ class FlipdotServer(object):
     
     def run(self):
         self.output_verbose("Starting server...")
+        # Load all bitmaps up front so rendering doesn't have to wait for the disk
+        FlipdotGraphics.ASSET_CACHE.check_interval = None
+        count = FlipdotGraphics.ASSET_CACHE.preload(self.ASSET_DIR)
+        self.output_verbose("Preloaded {0} bitmaps from '{1}'.".format(count, self.ASSET_DIR))
         for id, display in self.displays.items():
             display['graphics'].yellow()
             display['graphics'].commit()
         self.load_config()
         self.running = True
         self.listener_thread.start()
+        self.persister_thread.start()
+        if self.asset_check_interval:
+            self.asset_thread.start()
         self.control_loop()
     
     def stop(self):
         self.output_verbose("Stopping server...")
-        self.save_config()
         self.running = False
+        self.wakeup.set()
+        with self.persist_condition:
+            self.persist_condition.notify_all()
+        self.save_config()
+
+    def request_save(self):
+        # Have the configuration saved by the persister thread, unless it is being replayed from the file
+        with self.persist_condition:
+            if self.replaying or self.save_pending:
+                return
+            self.save_pending = True
+            self.persist_condition.notify_all()
+
+    def persist_loop(self):
+        with self.persist_condition:
+            while self.running:
+                if not self.save_pending:
+                    self.persist_condition.wait()
+                    continue
+                # Collect further changes for a while, stop() wakes this up early and saves by itself
+                self.persist_condition.wait(self.save_delay)
+                if not self.running:
+                    break
+                self.save_pending = False
+                self.persist_condition.release()
+                try:
+                    self.save_config()
+                except:
+                    traceback.print_exc()
+                finally:
+                    self.persist_condition.acquire()
+
+    def asset_loop(self):
+        # Reload modified bitmaps outside the control loop, so slow file systems don't hold up display updates
+        while self.running:
+            time.sleep(self.asset_check_interval)
+            try:
+                count = FlipdotGraphics.ASSET_CACHE.revalidate()
+            except:
+                traceback.print_exc()
+                continue
+            if count:
+                self.output_verbose("Reloaded {0} modified bitmaps.".format(count))
 
     def save_config(self):
-        self.output_verbose("Saving configuration to '{0}'...".format(self.CONFIG_FILE))
+        # The file is only written if the configuration changed since it was last saved or loaded
+        with self.config_lock:
+            data = self.dump_config()
+            config_hash = hashlib.sha1(data).hexdigest()
+            if config_hash == self.saved_hash:
+                return
+            self.output_verbose("Saving configuration to '{0}'...".format(self.CONFIG_FILE))
+            # Write a temporary file and rename it, so the file is never left half written
+            temp_file = self.CONFIG_FILE + ".tmp"
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.CONFIG_FILE)
+            self.saved_hash = config_hash
+
+    def dump_config(self):
+        with self.state_lock:
+            return self._dump_config()
 
+    def _dump_config(self):
         config_save = {
             'config': [],
             'messages': []
@@ -168,66 +452,115 @@ class FlipdotServer(object):
                 'message': message
             })
 
-        with open(self.CONFIG_FILE, 'w') as f:
-            json.dump(config_save, f, indent = 2)
+        return json.dumps(config_save, indent = 2, sort_keys = True).encode('utf-8')
 
     def load_config(self):
         self.output_verbose("Loading configuration from '{0}'...".format(self.CONFIG_FILE))
+        self.replaying = True
         try:
             with open(self.CONFIG_FILE, 'r') as f:
                 config_save = json.load(f)
 
             for message in config_save['config'] + config_save['messages']:
                 self.process_message(message)
+            # The file already contains the replayed state, so it doesn't need to be written again
+            self.saved_hash = hashlib.sha1(self.dump_config()).hexdigest()
         except (IOError, OSError, ValueError):
             self.output_verbose("'{0}' not found or invalid.".format(self.CONFIG_FILE))
+        finally:
+            self.replaying = False
     
     def set_config(self, display, key, value):
         try:
             func = getattr(self.displays[display]['controller'], "set_{0}".format(key))
             func(value)
+        except MatrixError as err:
+            self.output_verbose("Error setting '{0}' to '{1}' on display '{2}': {3}".format(key, value, display, err))
+            self.check_port_error(err)
+            self.check_missing_answer(display, err)
+            return False
         except:
             traceback.print_exc()
             return False
         return True
+
+    def commit_display(self, display):
+        # Send the current bitmap to a display. If that fails, it is sent again once the display is available.
+        try:
+            self.displays[display]['controller'].send_bitmap(self.current_bitmap[display].data)
+        except MatrixError as err:
+            self.output_verbose("Error committing changes to display '{0}': {1}".format(display, err))
+            self.update_data[display]['commit_pending'] = True
+            self.check_port_error(err)
+            self.check_missing_answer(display, err)
+            return False
+        self.update_data[display]['commit_pending'] = False
+        return True
+
+    def check_missing_answer(self, display, err):
+        # A display that didn't answer in time is tried again right away, its health decides when to stop.
+        # One that answered with an error is tried again after ERROR_RETRY_INTERVAL.
+        if err.code in (-1, -3):
+            self.update_data[display]['retry_now'] = True
+
+    def check_port_error(self, err):
+        # The serial port has been reopened, so none of the displays sharing it can be trusted to show their last bitmap
+        if err.code == -3:
+            for display in self.displays.values():
+                display['controller'].invalidate()
     
     def network_listen(self):
         self.socket.bind(('', self.port))
-        self.socket.settimeout(5.0)
+        self.socket.setblocking(False)
         self.output_verbose("Listening on port {0}".format(self.port))
-        self.socket.listen(1)
+        self.socket.listen(self.backlog)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers)
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        # Workers hand connections back through idle_connections and wake the selector up using this socket pair
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+        # Connections waiting for a message, mapped to their address and the time at which they are closed
+        waiting = {}
         
         try:
             while self.running:
                 try:
-                    # Wait for someone to connect
-                    conn, addr = self.socket.accept()
-                    ip, port = addr
-                    if self.allowed_ip_match is not None and not ip.startswith(self.allowed_ip_match):
-                        self.output_verbose("Discarding message from {0} on port {1}".format(*addr))
-                        discard_message(conn)
-                        continue
-                    
-                    self.output_verbose("Receiving message from %s on port %i" % addr)
-                    # Receive the message(s)
-                    messages = receive_message(conn)
-                    if messages is None:
-                        # We received an invalid message, just discard it
-                        continue
-                    
-                    if type(messages) not in (list, tuple):
-                        messages = [messages]
+                    for key, events in selector.select(timeout = 1.0):
+                        if key.fileobj is self.socket:
+                            connection = self.accept_connection()
+                            if connection is not None:
+                                conn, addr = connection
+                                waiting[conn] = (addr, MessageReader(conn), time.monotonic() + self.client_timeout)
+                                selector.register(conn, selectors.EVENT_READ)
+                        elif key.fileobj is self.wakeup_receiver:
+                            self.wakeup_receiver.recv(4096)
+                        else:
+                            # A message is arriving, let a worker handle it
+                            conn = key.fileobj
+                            selector.unregister(conn)
+                            addr, reader, close_time = waiting.pop(conn)
+                            try:
+                                executor.submit(self.handle_connection, conn, addr, reader)
+                            except RuntimeError:
+                                # The interpreter is shutting down
+                                self.close_connection(conn)
                     
-                    reply = {'success': True}
-                    for message in messages:
-                        reply = self.process_message(message)
-                        if not reply.get('success'):
+                    while True:
+                        try:
+                            conn, addr, reader = self.idle_connections.get_nowait()
+                        except queue.Empty:
                             break
+                        waiting[conn] = (addr, reader, time.monotonic() + self.keepalive_timeout)
+                        selector.register(conn, selectors.EVENT_READ)
                     
-                    if reply:
-                        send_message(conn, reply)
-                except socket.timeout: # Nothing special, just renew the socket every few seconds
-                    pass
+                    # Close connections that have been idle for too long
+                    now = time.monotonic()
+                    for conn, (addr, reader, close_time) in list(waiting.items()):
+                        if now >= close_time:
+                            selector.unregister(conn)
+                            del waiting[conn]
+                            self.close_connection(conn)
                 except KeyboardInterrupt:
                     raise
                 except:
@@ -235,32 +568,249 @@ class FlipdotServer(object):
         except KeyboardInterrupt:
             self.stop()
         finally:
+            for conn in waiting:
+                self.close_connection(conn)
+            selector.close()
             self.socket.close()
+            self.wakeup_receiver.close()
+            self.wakeup_sender.close()
+            executor.shutdown(wait = False)
+
+    def accept_connection(self):
+        # Returns the new connection and its address, or None if it was refused
+        try:
+            conn, addr = self.socket.accept()
+        except (BlockingIOError, socket.timeout):
+            return None
+        ip, port = addr
+        if self.allowed_ip_match is not None and not ip.startswith(self.allowed_ip_match):
+            self.output_verbose("Discarding message from {0} on port {1}".format(*addr))
+            discard_message(conn)
+            conn.close()
+            return None
+        
+        with self.connection_lock:
+            accepted = self.connection_count < self.max_connections
+            if accepted:
+                self.connection_count += 1
+        if not accepted:
+            self.output_verbose("Rejecting connection from {0} on port {1}, too many connections".format(*addr))
+            self.reject_connection(conn)
+            return None
+        
+        conn.setblocking(True)
+        return conn, addr
+
+    def reject_connection(self, conn):
+        try:
+            conn.settimeout(1.0)
+            send_message(conn, {'success': False, 'error': "Too many connections"})
+        except (socket.error, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def close_connection(self, conn):
+        conn.close()
+        with self.connection_lock:
+            self.connection_count -= 1
+    
+    def handle_connection(self, conn, addr, reader):
+        # Receive and answer messages, then give the connection back to the listener to wait for the next one
+        keep_open = False
+        try:
+            while True:
+                keep_open = False
+                self.output_verbose("Receiving message from %s on port %i" % addr)
+                try:
+                    request, version = reader.receive(time.monotonic() + self.client_timeout)
+                except socket.timeout:
+                    self.output_verbose("Timeout receiving message from {0} on port {1}".format(*addr))
+                    return
+                except (ConnectionError, ValueError):
+                    # The client closed the connection or sent an invalid message
+                    return
+                
+                if type(request) is dict and request.get('type') == 'subscribe':
+                    # The connection is taken over by the subscription, or closed if the subscription is invalid
+                    self.subscribe(conn, addr, request, version)
+                    conn = None
+                    return
+                
+                reply = self.process_request(request)
+                try:
+                    raw_reply = encode_message(reply, version)
+                except ValueError:
+                    # Version 1 limits messages to 99999 bytes, so tell the client instead of dropping the connection
+                    reply = {'success': False, 'error': "Reply too large for protocol version {0}".format(version)}
+                    if type(request) is dict and 'request_id' in request:
+                        reply = {'request_id': request['request_id'], 'reply': reply}
+                    raw_reply = encode_message(reply, version)
+                conn.settimeout(self.client_timeout)
+                conn.sendall(raw_reply)
+                keep_open = True
+                # Pipelined messages that are already in the reader's buffer won't wake up the selector
+                if not reader.pending:
+                    break
+        except:
+            traceback.print_exc()
+        finally:
+            if conn is None:
+                pass
+            elif keep_open and self.running:
+                self.idle_connections.put((conn, addr, reader))
+                try:
+                    self.wakeup_sender.send(b"\0")
+                except OSError:
+                    pass
+            else:
+                self.close_connection(conn)
+
+    def subscribe(self, conn, addr, message, version):
+        displays = message.get('displays')
+        if displays is None:
+            displays = list(self.displays.keys())
+        encoding = message.get('encoding', 'base64')
+        error = None
+        invalid_displays = [display for display in displays if display not in self.displays]
+        if invalid_displays:
+            error = "Invalid display: {0}".format(invalid_displays[0])
+        elif encoding not in BITMAP_ENCODINGS:
+            error = "Invalid bitmap encoding: {0}".format(encoding)
+        
+        try:
+            conn.settimeout(self.client_timeout)
+            send_message(conn, {'success': error is None, 'error': error}, version)
+        except (socket.error, OSError):
+            error = "Connection lost"
+        if error is not None:
+            self.close_connection(conn)
+            return
+        
+        self.output_verbose("Subscribing {0} on port {1} to {2}".format(addr[0], addr[1], ", ".join(displays)))
+        subscription = Subscription(conn, addr, set(displays), encoding, version)
+        with self.subscription_lock:
+            # The current bitmaps are sent first, taken together with registering so no frame is missed in between
+            for display in displays:
+                sequence, data = self.frames[display][-1]
+                if data is not None:
+                    subscription.put(display, sequence, data)
+            self.subscriptions.add(subscription)
+        thread = threading.Thread(target = self.serve_subscription, args = (subscription,))
+        thread.daemon = True
+        thread.start()
+
+    def serve_subscription(self, subscription):
+        # Push frames to a subscribed client until it closes the connection or stops reading
+        conn = subscription.conn
+        try:
+            while self.running:
+                frame = subscription.get(timeout = 1.0)
+                if frame is None:
+                    # Check whether the client is still there, anything else it sends is ignored
+                    conn.setblocking(False)
+                    try:
+                        if not conn.recv(4096):
+                            break
+                    except BlockingIOError:
+                        pass
+                    finally:
+                        conn.settimeout(self.client_timeout)
+                    continue
+                display, sequence, data = frame
+                send_message(conn, {
+                    'type': 'frame',
+                    'display': display,
+                    'sequence': sequence,
+                    'bitmap': encode_bitmap(data, subscription.encoding),
+                    'dropped': subscription.dropped[display]
+                }, subscription.version)
+        except (socket.error, OSError):
+            pass
+        except:
+            traceback.print_exc()
+        finally:
+            with self.subscription_lock:
+                self.subscriptions.discard(subscription)
+            self.output_verbose("Subscription of {0} on port {1} ended".format(*subscription.addr))
+            self.close_connection(conn)
+
+    def publish_frame(self, display, data):
+        # Give a new bitmap the next version and queue it for every subscription of the display, never blocks on the clients
+        with self.subscription_lock:
+            sequence = self.frames[display][-1][0] + 1
+            self.frames[display].append((sequence, data))
+            for subscription in self.subscriptions:
+                if display in subscription.displays:
+                    subscription.put(display, sequence, data)
+
+    def process_request(self, request):
+        # Process a message or list of messages, optionally wrapped with a request ID, and return the reply
+        if request is None:
+            return {'success': False, 'error': "Empty message"}
+        
+        # Requests carrying an ID are answered with the same ID, so clients can match pipelined replies
+        request_id = None
+        if type(request) is dict and 'request_id' in request:
+            request_id = request['request_id']
+            messages = request.get('messages')
+        else:
+            messages = request
+        
+        if type(messages) not in (list, tuple):
+            messages = [messages]
+        
+        reply = {'success': True}
+        for message in messages:
+            reply = self.process_message(message)
+            if not reply.get('success'):
+                break
+        
+        if request_id is not None:
+            reply = {'request_id': request_id, 'reply': reply}
+        return reply
     
     def process_message(self, message):
         success = True
         error = None
         
+        if message['type'] in ('control', 'data') and message.get('display') not in self.displays:
+            success = False
+            error = "Invalid display: {0}".format(message.get('display'))
+            return {'success': success, 'error': error}
+        
         if message['type'] == 'control':
             display = message['display']
-            for key, value in message['message'].items():
-                if key in self.config[display]:
-                    self.config[display][key] = value
-                    self.update_data[display]['config_keys_changed'].append(key)
-                else:
+            for key in message['message']:
+                if key not in self.config[display]:
                     success = False
                     error = "Invalid configuration option: {0}".format(key)
-                    break
-            if success:
-                self.save_config()
+                    return {'success': success, 'error': error}
+            changes = dict(message['message'])
+            with self.state_lock:
+                if any(self.config[display][key] != value for key, value in changes.items()):
+                    self.versions[display]['config'] += 1
+                self.config[display].update(changes)
+                # Queued while holding the lock, so the commands are in the same order as the changes to the state
+                self.send_command(display, 'control', changes)
+            self.request_save()
             return {'success': success, 'error': error}
         elif message['type'] == 'data':
             display = message['display']
-            self.current_message[display] = message['message']
-            self.update_data[display]['message_changed'] = True
-            if success:
-                self.save_config()
+            # The control loop can't report errors back, so a message it couldn't display is rejected here
+            error = self.validate_message(message.get('message'))
+            if error is not None:
+                success = False
+                return {'success': success, 'error': error}
+            with self.state_lock:
+                if message['message'] != self.current_message[display]:
+                    self.versions[display]['message'] += 1
+                self.current_message[display] = message['message']
+                self.send_command(display, 'data', message['message'])
+            self.request_save()
             return {'success': success, 'error': error}
+        elif message['type'] in ('query-config', 'query-message', 'query-bitmap') and 'if_newer_than' in message:
+            return self.process_versioned_query(message)
         elif message['type'] == 'query-config':
             displays = message.get('displays')
             keys = message.get('keys')
@@ -268,13 +818,9 @@ class FlipdotServer(object):
                 displays = self.displays.keys()
             
             reply = {}
-            for display in displays:
-                config = self.config[display]
-                reply_config = {}
-                for key, value in config.items():
-                    if keys is None or key in keys:
-                        reply_config[key] = value
-                reply[display] = reply_config
+            with self.state_lock:
+                for display in displays:
+                    reply[display] = self.get_display_config(display, keys)
             return reply
         elif message['type'] == 'query-hwconfig':
             return self.display_hwconfig
@@ -283,15 +829,45 @@ class FlipdotServer(object):
             if displays is None:
                 displays = self.displays.keys()
             
-            reply = dict(((display, self.current_message[display]) for display in displays))
+            with self.state_lock:
+                reply = dict(((display, self.current_message[display]) for display in displays))
+            return reply
+        elif message['type'] == 'query-health':
+            displays = message.get('displays')
+            if displays is None:
+                displays = self.displays.keys()
+            invalid_displays = [display for display in displays if display not in self.displays]
+            if invalid_displays:
+                return {'success': False, 'error': "Invalid display: {0}".format(invalid_displays[0])}
+
+            reply = dict(((display, self.displays[display]['controller'].get_health()) for display in displays))
             return reply
         elif message['type'] == 'query-bitmap':
             displays = message.get('displays')
             if displays is None:
                 displays = self.displays.keys()
+            encoding = message.get('encoding', 'list')
+            if encoding not in BITMAP_ENCODINGS:
+                return {'success': False, 'error': "Invalid bitmap encoding: {0}".format(encoding)}
             
-            reply = dict(((display, self.current_bitmap[display]) for display in displays))
+            reply = {}
+            for display in displays:
+                bitmap = self.current_bitmap[display]
+                reply[display] = encode_bitmap(bitmap.data, encoding) if bitmap is not None else None
             return reply
+        elif message['type'] == 'subscribe':
+            success = False
+            error = "A subscribe message has to be sent on its own"
+            return {'success': success, 'error': error}
+        elif message['type'] == 'hello':
+            # Let the client choose the newest framing version both sides know
+            versions = [version for version in message.get('protocol_versions', [1]) if version in PROTOCOL_VERSIONS]
+            return {
+                'success': True,
+                'protocol_version': max(versions) if versions else 1,
+                'protocol_versions': list(PROTOCOL_VERSIONS),
+                'bitmap_encodings': list(BITMAP_ENCODINGS)
+            }
         else:
             success = False
             error = "Invalid message type: {0}".format(message.get('type'))
@@ -299,108 +875,351 @@ class FlipdotServer(object):
         
         # This should never be called
         return {'success': success, 'error': error}
+
+    def validate_message(self, message):
+        # Check the structure of a data message, returns an error or None if it can be displayed
+        if message is None:
+            return None
+        if not isinstance(message, dict):
+            return "Invalid message: {0}".format(message)
+        if message.get('type') == 'single':
+            return self.validate_single_message(message)
+        elif message.get('type') == 'sequence':
+            messages = message.get('messages')
+            if not isinstance(messages, list) or not messages:
+                return "Sequence message without messages"
+            if 'interval' not in message:
+                return "Sequence message without interval"
+            for submessage in messages:
+                if not isinstance(submessage, dict) or submessage.get('type') != 'single':
+                    return "Sequence messages can only contain single messages"
+                duration = submessage.get('duration') or message['interval']
+                if not isinstance(duration, (int, float)) or isinstance(duration, bool) or duration <= 0:
+                    return "Message in sequence has neither a duration nor a default interval"
+                error = self.validate_single_message(submessage)
+                if error is not None:
+                    return error
+            return None
+        return "Invalid message type: {0}".format(message.get('type'))
+
+    def validate_single_message(self, message):
+        submessages = message.get('submessages')
+        if not isinstance(submessages, list):
+            return "Single message without submessages"
+        for submessage in submessages:
+            if not isinstance(submessage, dict):
+                return "Invalid submessage: {0}".format(submessage)
+            refresh_interval = submessage.get('refresh_interval')
+            if refresh_interval not in (None, 0, 'minute') and (not isinstance(refresh_interval, (int, float)) or refresh_interval < 0):
+                return "Invalid refresh interval: {0}".format(refresh_interval)
+            if submessage.get('type') == 'bitmap':
+                try:
+                    bitmap = decode_bitmap(submessage['bitmap'])
+                    bytes(bitmap)
+                except (KeyError, TypeError, ValueError):
+                    return "Invalid bitmap submessage"
+            elif submessage.get('type') == 'graphics':
+                func = submessage.get('func')
+                method = getattr(FlipdotGraphics, func, None) if isinstance(func, str) and not func.startswith('_') else None
+                if not callable(method):
+                    return "Invalid graphics function: {0}".format(func)
+                params = submessage.get('params')
+                if not isinstance(params, dict):
+                    return "Graphics submessage without params"
+                signature = self.get_graphics_signature(func)
+                try:
+                    signature.bind(None, **params)
+                    if func in self.GRAPHICS_FORWARDED_PARAMS:
+                        # The keyword arguments the function doesn't take itself only fail once they're passed on
+                        target, passed = self.GRAPHICS_FORWARDED_PARAMS[func]
+                        forwarded = dict((name, value) for name, value in params.items() if name not in signature.parameters)
+                        for name in passed:
+                            if name in forwarded:
+                                raise TypeError("got multiple values for argument '{0}'".format(name))
+                        self.get_graphics_signature(target).bind_partial(None, **forwarded)
+                except TypeError as err:
+                    return "Invalid parameters for '{0}': {1}".format(func, err)
+            else:
+                return "Invalid submessage type: {0}".format(submessage.get('type'))
+        return None
+
+    def get_graphics_signature(self, func):
+        signature = self.graphics_signatures.get(func)
+        if signature is None:
+            signature = self.graphics_signatures[func] = inspect.signature(getattr(FlipdotGraphics, func))
+        return signature
+
+    def get_display_config(self, display, keys = None):
+        return dict((key, value) for key, value in self.config[display].items() if keys is None or key in keys)
+
+    def process_versioned_query(self, message):
+        """
+        Answer a query with 'if_newer_than', which is either one version for all displays or a mapping of displays to versions.
+        Every display is answered with its current version, and with its data only if that is newer than the given one.
+        With 'delta', a bitmap query returns just the changed column ranges if the given bitmap version is still known.
+        """
+
+        displays = message.get('displays')
+        if displays is None:
+            displays = list(self.displays.keys())
+        invalid_displays = [display for display in displays if display not in self.displays]
+        if invalid_displays:
+            return {'success': False, 'error': "Invalid display: {0}".format(invalid_displays[0])}
+        if_newer_than = message['if_newer_than']
+        if isinstance(if_newer_than, dict):
+            known_versions = dict((display, if_newer_than.get(display)) for display in displays)
+        else:
+            known_versions = dict((display, if_newer_than) for display in displays)
+        for version in known_versions.values():
+            if version is not None and type(version) is not int:
+                return {'success': False, 'error': "Invalid version: {0}".format(version)}
+        encoding = message.get('encoding', 'list')
+        if encoding not in BITMAP_ENCODINGS:
+            return {'success': False, 'error': "Invalid bitmap encoding: {0}".format(encoding)}
+        
+        reply = {}
+        if message['type'] == 'query-bitmap':
+            with self.subscription_lock:
+                frames = dict((display, list(self.frames[display])) for display in displays)
+            for display in displays:
+                known = known_versions[display]
+                version, data = frames[display][-1]
+                reply[display] = {'version': version, 'modified': known is None or version > known}
+                if not reply[display]['modified']:
+                    continue
+                known_data = dict(frames[display]).get(known)
+                if message.get('delta') and known_data is not None and data is not None:
+                    col_bytes = (self.display_hwconfig[display]['height'] + 7) // 8
+                    ranges = self.displays[display]['controller'].get_dirty_ranges(known_data, data, col_bytes)
+                    reply[display]['changes'] = [{
+                        'start': start,
+                        'bitmap': encode_bitmap(data[start*col_bytes:end*col_bytes], encoding)
+                    } for start, end in ranges]
+                else:
+                    reply[display]['bitmap'] = encode_bitmap(data, encoding) if data is not None else None
+            return reply
+        
+        key = 'config' if message['type'] == 'query-config' else 'message'
+        with self.state_lock:
+            for display in displays:
+                known = known_versions[display]
+                version = self.versions[display][key]
+                reply[display] = {'version': version, 'modified': known is None or version > known}
+                if not reply[display]['modified']:
+                    continue
+                if key == 'config':
+                    reply[display]['config'] = self.get_display_config(display, message.get('keys'))
+                else:
+                    reply[display]['message'] = self.current_message[display]
+        return reply
     
+    def build_layers(self, message, dynamic_submessages):
+        """
+        Split the submessages of a single message into layers which can be rendered independently.
+        Consecutive static submessages share one layer, every dynamic submessage gets its own layer.
+        The rendered image of each layer is kept until the message changes, so static content is only rendered once.
+        """
+
+        layers = []
+        for index in range(len(message['submessages'])):
+            dynamic = index in dynamic_submessages
+            if dynamic or not layers or layers[-1]['dynamic']:
+                layers.append({'submessages': [], 'dynamic': dynamic, 'image': None})
+            layers[-1]['submessages'].append(index)
+        return layers
+
+    def render_submessage(self, display, submessage):
+        graphics = self.displays[display]['graphics']
+        if submessage['type'] == 'bitmap':
+            img = graphics.bitmap_to_image(decode_bitmap(submessage['bitmap']), graphics.controller.width, graphics.controller.height)
+            graphics.bitmap(img, left = 0, top = 0)
+        elif submessage['type'] == 'graphics':
+            func = getattr(graphics, submessage['func'])
+            try:
+                func(**submessage['params'])
+            except:
+                traceback.print_exc()
+
+    def render_layer(self, display, submessages):
+        graphics = self.displays[display]['graphics']
+        graphics.init_image()
+        for submessage in submessages:
+            self.render_submessage(display, submessage)
+        return graphics.get_layer()
+
+    def send_command(self, display, command, data):
+        # Hand a change over to the control loop. 'data' must not be modified afterwards.
+        self.commands.append((display, command, data))
+        self.wakeup.set()
+
+    def apply_commands(self):
+        # Apply all queued changes in order and schedule the affected displays. Only used by the control loop.
+        while True:
+            try:
+                display, command, data = self.commands.popleft()
+            except IndexError:
+                break
+            update_data = self.update_data[display]
+            if command == 'control':
+                update_data['config'].update(data)
+                update_data['config_keys_changed'] += [key for key in data if key not in update_data['config_keys_changed']]
+            elif command == 'data':
+                update_data['message'] = data
+                update_data['message_changed'] = True
+                if data is None:
+                    # Without a message, nothing of the previous one is due anymore
+                    update_data['dynamic_submessages'] = {}
+                    update_data['layers'] = []
+            self.schedule(display)
+
+    def schedule(self, display, deadline = None):
+        # Make the control loop update a display at the given time (time.time() based), or right away. Only used by the control loop.
+        if deadline is None:
+            deadline = time.time()
+        self.next_update[display] = deadline
+        heapq.heappush(self.deadlines, (deadline, display))
+
+    def get_next_deadline(self, display):
+        # The earliest time at which something on the display has to change, or None if nothing does until a new message arrives
+        update_data = self.update_data[display]
+        message = update_data['message']
+        deadlines = []
+        if message is not None and message['type'] == 'sequence':
+            actual_message = message['messages'][update_data['sequence_cur_pos']]
+            deadlines.append(update_data['sequence_last_switched'] + (actual_message.get('duration', message['interval']) or message['interval']))
+        for refresh_interval, last_refresh in update_data['dynamic_submessages'].values():
+            if refresh_interval == 'minute':
+                deadlines.append((last_refresh // 60 + 1) * 60)
+            else:
+                deadlines.append(last_refresh + refresh_interval)
+        if update_data['commit_pending'] or update_data['config_keys_changed']:
+            # Retry once a parked display is probed again, right away if it didn't answer, or after a while if it answered with an error
+            health = self.displays[display]['controller'].health
+            if health.next_probe is not None:
+                deadlines.append(time.time() + max(0.0, health.next_probe - time.monotonic()))
+            elif update_data['retry_now']:
+                deadlines.append(time.time())
+            else:
+                deadlines.append(time.time() + self.ERROR_RETRY_INTERVAL)
+        return min(deadlines) if deadlines else None
+
+    def update_display(self, display, now_time):
+        """
+        Apply configuration changes to a display and re-render it if its message changed or parts of it are due.
+        Returns the time at which the display needs to be updated next, see get_next_deadline().
+        """
+
+        update_data = self.update_data[display]
+        controller = self.displays[display]['controller']
+        message = update_data['message']
+        message_changed = update_data['message_changed']
+        update_data['message_changed'] = False
+        update_data['retry_now'] = False
+        try:
+            # A display that is parked after failing repeatedly fails immediately, so retries wait until it is available again
+            if controller.health.is_available():
+                # Process configuration changes, keeping the ones that failed to retry them later
+                update_data['config_keys_changed'] = [key for key in update_data['config_keys_changed']
+                    if not self.set_config(display, key, update_data['config'][key])]
+
+                # Send the bitmap again if the display didn't accept it before
+                if update_data['commit_pending'] and not message_changed:
+                    self.commit_display(display)
+
+            # If only config changes were made and no message was sent, we're done
+            if message is None:
+                return self.get_next_deadline(display)
+
+            # A message has been changed
+            if message_changed:
+                update_data['sequence_cur_pos'] = 0
+                update_data['sequence_last_switched'] = now_time if message['type'] == 'sequence' else None
+
+            # If we have a sequence message, get the current sub-message and check if it has expired
+            if message['type'] == 'sequence':
+                actual_message = message['messages'][update_data['sequence_cur_pos']]
+                sequence_needs_switching = now_time - update_data['sequence_last_switched'] >= (actual_message.get('duration', message['interval']) or message['interval'])
+            else:
+                actual_message = message
+                sequence_needs_switching = False
+
+            # If the submessage has expired, switch to the next one
+            if sequence_needs_switching:
+                if update_data['sequence_cur_pos'] == len(message['messages']) - 1:
+                    update_data['sequence_cur_pos'] = 0
+                else:
+                    update_data['sequence_cur_pos'] += 1
+                actual_message = message['messages'][update_data['sequence_cur_pos']]
+                update_data['sequence_last_switched'] = now_time
+
+            # Register dynamic submessages and split the message into layers
+            if sequence_needs_switching or message_changed:
+                update_data['dynamic_submessages'] = {}
+                for index, submessage in enumerate(actual_message['submessages']):
+                    refresh_interval = submessage.get('refresh_interval', 0)
+                    if refresh_interval:
+                        update_data['dynamic_submessages'][index] = [refresh_interval, now_time]
+                update_data['layers'] = self.build_layers(actual_message, update_data['dynamic_submessages'])
+
+            # Check which dynamic submessages need to be updated
+            due_submessages = set()
+            for index, (refresh_interval, last_refresh) in update_data['dynamic_submessages'].items():
+                if refresh_interval == 'minute':
+                    if now_time // 60 != last_refresh // 60:
+                        due_submessages.add(index)
+                elif now_time - last_refresh >= refresh_interval:
+                    due_submessages.add(index)
+
+            # If a refresh is required (message changed, dynamic message needs refresh or submessage expired),
+            # re-render the layers that changed and composite them
+            if message_changed or due_submessages or sequence_needs_switching:
+                for layer in update_data['layers']:
+                    if layer['image'] is None or due_submessages.intersection(layer['submessages']):
+                        layer['image'] = self.render_layer(display, [actual_message['submessages'][index] for index in layer['submessages']])
+                        for index in layer['submessages']:
+                            if index in update_data['dynamic_submessages']:
+                                update_data['dynamic_submessages'][index][1] = now_time
+                graphics = self.displays[display]['graphics']
+                graphics.init_image()
+                for layer in update_data['layers']:
+                    graphics.paste_layer(layer['image'])
+                self.current_bitmap[display] = graphics.get_framebuffer()
+                # Subscribers only get a frame if the bitmap actually changed, not for every refresh
+                data = bytes(self.current_bitmap[display].data)
+                if data != self.frames[display][-1][1]:
+                    self.publish_frame(display, data)
+                self.commit_display(display)
+            return self.get_next_deadline(display)
+        except Exception:
+            traceback.print_exc()
+            return now_time + self.ERROR_RETRY_INTERVAL
+
     def control_loop(self):
-        last_check_dt = datetime.datetime.now()
+        """
+        Update the displays whenever one of them is due. Every display has one deadline in a heap, set by the previous update
+        or by a command, so the loop sleeps until the earliest deadline or until a command arrives.
+        Commands are only applied between display updates, so an update always works on a consistent state.
+        """
+
         while self.running:
             try:
+                if not self.commands and (not self.deadlines or self.deadlines[0][0] > time.time()):
+                    self.wakeup.wait(self.deadlines[0][0] - time.time() if self.deadlines else None)
+                # Cleared before taking the commands, so a command arriving in between wakes up the next wait
+                self.wakeup.clear()
+                self.apply_commands()
                 now_time = time.time()
-                now_dt = datetime.datetime.now()
-                for display, message in self.current_message.items():
-                    update_data = self.update_data[display]
-                    try:
-                        # Process configuration changes
-                        for key in update_data['config_keys_changed']:
-                            try:
-                                self.set_config(display, key, self.config[display][key])
-                            except MatrixError as err:
-                                print("Error setting '{0}' to '{1}' on display '{2}': {3}".format(key, self.config[display][key], display, err))
-                        update_data['config_keys_changed'] = []
-                        
-                        # If only config changes were made and no message was sent, commit the changes and we're done
-                        if message is None:
-                            time.sleep(0.25)
-                            continue
-                        
-                        # A message has been changed
-                        if update_data['message_changed']:
-                            if message['type'] == 'sequence':
-                                update_data['sequence_cur_pos'] = 0
-                                update_data['sequence_last_switched'] = now_time
-                            elif message['type'] == 'single':
-                                update_data['sequence_cur_pos'] = 0
-                                update_data['sequence_last_switched'] = None
-                        
-                        # If we have a sequence message, get the current sub-message and check if it has expired
-                        if message['type'] == 'sequence':
-                            actual_message = message['messages'][update_data['sequence_cur_pos']]
-                            sequence_needs_switching = now_time - update_data['sequence_last_switched'] >= (actual_message.get('duration', message['interval']) or message['interval'])
-                        else:
-                            actual_message = message
-                            sequence_needs_switching = False
-
-                        # If the submessage has expired, switch to the next one
-                        if sequence_needs_switching:
-                            if update_data['sequence_cur_pos'] == len(message['messages']) - 1:
-                                update_data['sequence_cur_pos'] = 0
-                            else:
-                                update_data['sequence_cur_pos'] += 1
-                            actual_message = message['messages'][update_data['sequence_cur_pos']]
-                            update_data['sequence_last_switched'] = now_time
-                        
-                        # Register dynamic submessages
-                        if sequence_needs_switching or update_data['message_changed']:
-                            for index, submessage in enumerate(actual_message['submessages']):
-                                refresh_interval = submessage.get('refresh_interval', 0)
-                                if refresh_interval:
-                                    update_data['dynamic_submessages'][index] = [refresh_interval, now_time]
-                                else:
-                                    try:
-                                        update_data['dynamic_submessages'].pop(index)
-                                    except KeyError:
-                                        pass
-                        
-                        # Check if any dynamic messages need to be updated (the first message to need updating causes all messages to be updated)
-                        dynamic_message_changed = False
-                        if update_data['dynamic_submessages']:
-                            for index, (refresh_interval, last_refresh) in update_data['dynamic_submessages'].items():
-                                if refresh_interval == 'minute':
-                                    if now_dt.minute != last_check_dt.minute:
-                                        dynamic_message_changed = True
-                                        break
-                                elif now_time - last_refresh >= refresh_interval:
-                                    dynamic_message_changed = True
-                                    break
-                        
-                        # Determine whether the bitmap needs to be refreshed (Message changed, dynamic message needs refresh or submessage expired)
-                        needs_refresh = update_data['message_changed'] or dynamic_message_changed or sequence_needs_switching
-                        #print(update_data['message_changed'], dynamic_message_changed, sequence_needs_switching)
-
-                        # If a refresh is required, determine what to do
-                        if needs_refresh:
-                            for index, submessage in enumerate(actual_message['submessages']):
-                                if submessage['type'] == 'bitmap':
-                                    self.displays[display]['graphics'].bitmap(self.displays[display]['graphics'].bitmap_to_image(submessage['bitmap']), x = 0, y = 0)
-                                elif submessage['type'] == 'graphics':
-                                    func = getattr(self.displays[display]['graphics'], submessage['func'])
-                                    try:
-                                        func(**submessage['params'])
-                                    except:
-                                        traceback.print_exc()
-                                    if index in update_data['dynamic_submessages']:
-                                        update_data['dynamic_submessages'][index][1] = now_time
-                            self.current_bitmap[display] = self.displays[display]['graphics'].get_bitmap()
-                            try:
-                                self.displays[display]['graphics'].commit()
-                            except MatrixError as err:
-                                print("Error committing changes to display '{0}': {1}".format(display, err))
-                        update_data['message_changed'] = False
-                    except Exception as err:
-                        traceback.print_exc()
-                    finally:
-                        update_data['message_changed'] = False
-                last_check_dt = now_dt
-                time.sleep(0.25)
+                due_displays = []
+                while self.deadlines and self.deadlines[0][0] <= now_time:
+                    deadline, display = heapq.heappop(self.deadlines)
+                    # Deadlines which have been replaced by a newer one are skipped
+                    if self.next_update.get(display) == deadline:
+                        del self.next_update[display]
+                        due_displays.append(display)
+                for display in due_displays:
+                    deadline = self.update_display(display, now_time)
+                    if deadline is not None:
+                        self.schedule(display, deadline)
             except KeyboardInterrupt:
                 self.stop()
             except:
@@ -409,12 +1228,33 @@ class FlipdotServer(object):
 
 
 class FlipdotClient(object):
-    def __init__(self, host, port = 1820, timeout = 3.0):
+    """
+    Sends messages to a FlipdotServer. If 'keep_alive' is set, one connection is kept open and used for all messages,
+    and opened again if the server has closed it in the meantime. Servers which close the connection after
+    every reply are supported as well. Older servers leave the connection open without reading from it:
+    they don't know the hello message, and if a reused connection times out while a new one works, 'keep_alive'
+    is turned off for them.
+    Before the first message, the client asks the server for the newest framing version and the bitmap encodings it supports,
+    unless 'protocol_version' is given.
+    """
+
+    PIPELINE_WINDOW = 16
+
+    def __init__(self, host, port = 1820, timeout = 3.0, keep_alive = True, protocol_version = None):
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.protocol_version = protocol_version
+        self.bitmap_encoding = 'list'
+        self.sock = None
+        self.reader = None
+        self.lock = threading.RLock()
+        self.next_request_id = 1
         self.queue = []
         self.display_submessages = {}
+        self.bitmaps = {}
+        self.hwconfig = None
 
     def __getattr__(self, key):
         """
@@ -426,19 +1266,144 @@ class FlipdotClient(object):
             self.commit()
         return _graphics_mapper
 
-    def send_raw_message(self, message, expect_reply = True):
-        reply = None
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(self.timeout)
             sock.connect((self.host, self.port))
-            send_message(sock, message)
-            
-            if expect_reply:
-                reply = receive_message(sock)
-        finally:
+        except:
             sock.close()
-        return reply
+            raise
+        self.sock = sock
+        self.reader = MessageReader(sock)
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+                self.reader = None
+
+    def negotiate(self):
+        # Servers that don't know the hello message answer it with an error, so they are sent version 1 messages and list bitmaps
+        with self.lock:
+            if self.sock is None:
+                self.connect()
+            try:
+                send_message(self.sock, {'type': 'hello', 'protocol_versions': list(PROTOCOL_VERSIONS)})
+                reply, version = self.reader.receive()
+            except:
+                self.close()
+                raise
+            if reply.get('success'):
+                self.protocol_version = reply['protocol_version']
+                self.bitmap_encoding = 'base64' if 'base64' in reply.get('bitmap_encodings', ()) else 'list'
+            else:
+                # Servers that don't know the hello message don't read further messages on a connection either
+                self.protocol_version = 1
+                self.bitmap_encoding = 'list'
+                self.keep_alive = False
+            if not self.keep_alive:
+                self.close()
+
+    def encode_bitmaps(self, message):
+        # Put bitmap submessages in the most compact encoding the server supports
+        if isinstance(message, (list, tuple)):
+            return [self.encode_bitmaps(item) for item in message]
+        if not isinstance(message, dict):
+            return message
+        if message.get('type') == 'bitmap' and not isinstance(message.get('bitmap'), (str, type(None))):
+            return dict(message, bitmap = encode_bitmap(message['bitmap'], self.bitmap_encoding))
+        encoded = dict(message)
+        for key in ('message', 'messages', 'submessages'):
+            if key in encoded:
+                encoded[key] = self.encode_bitmaps(encoded[key])
+        return encoded
+
+    def send_raw_message(self, message, expect_reply = True):
+        with self.lock:
+            if self.protocol_version is None:
+                self.negotiate()
+            message = self.encode_bitmaps(message)
+            retried = False
+            while True:
+                reused = self.sock is not None
+                if not reused:
+                    self.connect()
+                try:
+                    send_message(self.sock, message, self.protocol_version)
+                    # The reply is read even if it isn't needed, so it doesn't end up as the reply to the next message
+                    reply = self.reader.receive()[0] if expect_reply or self.keep_alive else None
+                except OSError as err:
+                    self.close()
+                    # The server may have closed a reused connection in the meantime, or may not read from it at all.
+                    # Either way, try once more on a new one.
+                    if not reused:
+                        raise
+                    retried = isinstance(err, socket.timeout)
+                    continue
+                except:
+                    self.close()
+                    raise
+                if retried:
+                    # A new connection works where the reused one timed out, so the server doesn't keep connections open
+                    self.keep_alive = False
+                if not self.keep_alive:
+                    self.close()
+                return reply if expect_reply else None
+
+    def send_pipelined(self, messages):
+        """
+        Send several messages (or lists of messages) without waiting for each reply, and return the replies in the same order.
+        Every request carries an ID which the server returns with its reply. This requires a server that keeps connections open.
+        """
+
+        with self.lock:
+            if self.protocol_version is None:
+                self.negotiate()
+            if self.sock is None:
+                self.connect()
+            request_ids = []
+            replies = {}
+            try:
+                for message in messages:
+                    request_id = self.next_request_id
+                    self.next_request_id += 1
+                    try:
+                        send_message(self.sock, {'request_id': request_id, 'messages': self.encode_bitmaps(message)}, self.protocol_version)
+                    except OSError:
+                        # The server may have answered with an error and closed the connection, which tells more than the failed send
+                        try:
+                            self.receive_pipelined(request_ids, replies)
+                        except OSError:
+                            pass
+                        raise
+                    request_ids.append(request_id)
+                    # Don't let too many replies pile up, or both sides could end up waiting for each other to read
+                    if len(request_ids) - len(replies) >= self.PIPELINE_WINDOW:
+                        self.receive_pipelined(request_ids, replies)
+                while len(replies) < len(request_ids):
+                    self.receive_pipelined(request_ids, replies)
+            except:
+                self.close()
+                raise
+            if not self.keep_alive:
+                self.close()
+            return [replies[request_id] for request_id in request_ids]
+
+    def receive_pipelined(self, request_ids, replies):
+        # Errors about the connection itself, like a rejected connection or broken framing, don't belong to a request
+        reply = self.reader.receive()[0]
+        if not isinstance(reply, dict) or reply.get('request_id') not in request_ids or 'reply' not in reply:
+            error = reply.get('error') if isinstance(reply, dict) else None
+            raise ValueError("Pipelined request failed: {0}".format(error or "Unexpected reply: {0}".format(reply)))
+        replies[reply['request_id']] = reply['reply']
     
     def clear_queue(self):
         self.queue = []
@@ -463,17 +1428,39 @@ class FlipdotClient(object):
     def build_control_message(self, display, message):
         return {'type': 'control', 'display': display, 'message': message}
     
-    def build_config_query_message(self, displays, keys):
-        return {'type': 'query-config', 'displays': displays, 'keys': keys}
+    def build_config_query_message(self, displays, keys, if_newer_than = None):
+        message = {'type': 'query-config', 'displays': displays, 'keys': keys}
+        if if_newer_than is not None:
+            message['if_newer_than'] = if_newer_than
+        return message
     
     def build_hwconfig_query_message(self):
         return {'type': 'query-hwconfig'}
     
-    def build_message_query_message(self, displays):
-        return {'type': 'query-message', 'displays': displays}
+    def build_message_query_message(self, displays, if_newer_than = None):
+        message = {'type': 'query-message', 'displays': displays}
+        if if_newer_than is not None:
+            message['if_newer_than'] = if_newer_than
+        return message
     
-    def build_bitmap_query_message(self, displays):
-        return {'type': 'query-bitmap', 'displays': displays}
+    def build_bitmap_query_message(self, displays, encoding = None, if_newer_than = None, delta = False):
+        message = {'type': 'query-bitmap', 'displays': displays}
+        if encoding is not None:
+            message['encoding'] = encoding
+        if if_newer_than is not None:
+            message['if_newer_than'] = if_newer_than
+            if delta:
+                message['delta'] = True
+        return message
+    
+    def build_health_query_message(self, displays):
+        return {'type': 'query-health', 'displays': displays}
+    
+    def build_subscribe_message(self, displays, encoding = None):
+        message = {'type': 'subscribe', 'displays': displays}
+        if encoding is not None:
+            message['encoding'] = encoding
+        return message
 
     ######################### LEVEL 2 MESSAGES
 
@@ -525,17 +1512,90 @@ class FlipdotClient(object):
 
     #########################
     
-    def get_config(self, displays = None, keys = None):
-        return self.send_raw_message(self.build_config_query_message(displays, keys))
+    def get_config(self, displays = None, keys = None, if_newer_than = None):
+        return self.send_raw_message(self.build_config_query_message(displays, keys, if_newer_than))
     
     def get_hwconfig(self):
         return self.send_raw_message(self.build_hwconfig_query_message())
     
-    def get_message(self, displays = None):
-        return self.send_raw_message(self.build_message_query_message(displays))
+    def get_message(self, displays = None, if_newer_than = None):
+        return self.send_raw_message(self.build_message_query_message(displays, if_newer_than))
     
-    def get_bitmap(self, displays):
-        return self.send_raw_message(self.build_bitmap_query_message(displays))
+    def get_bitmap(self, displays = None):
+        # Bitmaps are returned as lists, whichever encoding has been used to transfer them
+        with self.lock:
+            if self.protocol_version is None:
+                self.negotiate()
+            reply = self.send_raw_message(self.build_bitmap_query_message(displays, self.bitmap_encoding if self.bitmap_encoding != 'list' else None))
+        if reply.get('success') is False:
+            return reply
+        return dict((display, list(decode_bitmap(bitmap)) if bitmap is not None else None) for display, bitmap in reply.items())
+    
+    def sync_bitmaps(self, displays = None):
+        """
+        Bring local copies of the bitmaps up to date and return them as a dictionary of displays to (version, bitmap) tuples.
+        Only the columns that changed since the local copy are transferred, nothing at all if a display didn't change.
+        Servers without versioned queries send the whole bitmaps every time, and the versions are None.
+        """
+
+        with self.lock:
+            if self.protocol_version is None:
+                self.negotiate()
+            known_versions = dict((display, version) for display, (version, bitmap) in self.bitmaps.items())
+            reply = self.send_raw_message(self.build_bitmap_query_message(displays,
+                self.bitmap_encoding if self.bitmap_encoding != 'list' else None, if_newer_than = known_versions, delta = True))
+            if reply.get('success') is False:
+                return reply
+            for display, state in reply.items():
+                if not isinstance(state, dict) or 'modified' not in state:
+                    # Servers without versioned queries ignore 'if_newer_than' and send the whole bitmap
+                    self.bitmaps[display] = (None, bytes(decode_bitmap(state)) if state is not None else None)
+                    continue
+                if not state['modified']:
+                    continue
+                if 'changes' in state:
+                    if self.hwconfig is None:
+                        self.hwconfig = self.get_hwconfig()
+                    col_bytes = (self.hwconfig[display]['height'] + 7) // 8
+                    bitmap = bytearray(self.bitmaps[display][1])
+                    for change in state['changes']:
+                        data = decode_bitmap(change['bitmap'])
+                        bitmap[change['start']*col_bytes:change['start']*col_bytes + len(data)] = data
+                    bitmap = bytes(bitmap)
+                else:
+                    bitmap = bytes(decode_bitmap(state['bitmap'])) if state['bitmap'] is not None else None
+                self.bitmaps[display] = (state['version'], bitmap)
+            return dict((display, self.bitmaps[display]) for display in reply)
+    
+    def get_health(self, displays = None):
+        return self.send_raw_message(self.build_health_query_message(displays))
+    
+    def subscribe(self, displays = None, timeout = None):
+        """
+        Yield a frame for every new bitmap of the given displays, starting with the current ones.
+        Each frame is a dictionary with 'display', 'sequence', 'bitmap' (as bytes) and 'dropped', the number of frames
+        of that display the server skipped because they were read too slowly. The subscription uses a connection of its own,
+        which is closed when the generator is closed. If 'timeout' is given, socket.timeout is raised
+        if no frame arrives within that many seconds.
+        """
+
+        with self.lock:
+            if self.protocol_version is None:
+                self.negotiate()
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        try:
+            reader = MessageReader(sock)
+            send_message(sock, self.build_subscribe_message(displays, self.bitmap_encoding), self.protocol_version)
+            reply = reader.receive()[0]
+            if not reply.get('success'):
+                raise ValueError("Subscription failed: {0}".format(reply.get('error')))
+            sock.settimeout(timeout)
+            while True:
+                frame = reader.receive()[0]
+                frame['bitmap'] = bytes(decode_bitmap(frame['bitmap']))
+                yield frame
+        finally:
+            sock.close()
 
     #########################
     
@@ -15,9 +15,96 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+import threading
+
 def get_serial_port(port):
     import serial
-    if isinstance(port, serial.Serial):
+    # Ports created by serial_for_url, e.g. for loop:// or socket:// URLs, aren't serial.Serial instances
+    if isinstance(port, serial.SerialBase):
         return port
     else:
-        return serial.Serial(port, baudrate = 115200, timeout = 5)
\ No newline at end of file
+        # Besides device names, this accepts URLs such as socket://host:port
+        return serial.serial_for_url(port, baudrate = 115200, timeout = 5)
+
+class LRUCache(object):
+    """
+    A thread-safe cache which discards the least recently used entries once it holds more than 'maxsize' entries.
+    If 'maxcost' is given, entries are also discarded while the sum of their costs exceeds it.
+    The cost of an entry is determined by calling 'sizeof' on its value.
+    """
+
+    def __init__(self, maxsize = 128, maxcost = None, sizeof = None):
+        self.maxsize = maxsize
+        self.maxcost = maxcost
+        self.sizeof = sizeof
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _entry_cost(self, value):
+        return self.sizeof(value) if self.sizeof else 0
+
+    def get(self, key, default = None):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.cost -= self._entry_cost(self.entries.pop(key))
+            self.entries[key] = value
+            self.cost += self._entry_cost(value)
+            # Always keep the newest entry, even if it exceeds the cost limit on its own
+            while len(self.entries) > 1 and (len(self.entries) > self.maxsize or (self.maxcost is not None and self.cost > self.maxcost)):
+                old_key, old_value = self.entries.popitem(last = False)
+                self.cost -= self._entry_cost(old_value)
+                self.evictions += 1
+        return value
+
+    def get_or_create(self, key, factory):
+        # The factory is called outside the lock, so concurrent misses on the same key may both create the value
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = self.put(key, factory())
+        return value
+
+    def pop(self, key, default = None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries.pop(key)
+            self.cost -= self._entry_cost(value)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.cost = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'cost': self.cost,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
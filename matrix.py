@@ -5,7 +5,7 @@ import datetime
 import flipdot
 import time
 
-from PIL import Image, ImageSequence
+from PIL import Image
 
 def main():
     parser = argparse.ArgumentParser()
@@ -14,6 +14,8 @@ def main():
     parser.add_argument('-w', '--width', type = int, default = 28, required = False)
     parser.add_argument('-t', '--text', type = str, required = False)
     parser.add_argument('-vt', '--vertical-text', type = str, required = False)
+    parser.add_argument('-m', '--marquee', type = str, required = False)
+    parser.add_argument('-sp', '--speed', type = float, default = 20.0, required = False)
     parser.add_argument('-s', '--size', type = int, default = 16, required = False)
     parser.add_argument('-f', '--font', type = str, default = "Arial Bold", required = False)
     parser.add_argument('-ha', '--horizontal-align', type = str, choices = ('left', 'center', 'right'), default = 'center', required = False)
@@ -22,6 +24,7 @@ def main():
     parser.add_argument('-i', '--image', type = argparse.FileType('rb'), required = False)
     parser.add_argument('-l', '--loop', action = 'store_true')
     parser.add_argument('-d', '--delay', type = float, default = 0.0, required = False)
+    parser.add_argument('-di', '--dither', type = str, choices = flipdot.DITHER_MODES, default = 'threshold', required = False)
     args = parser.parse_args()
 
     matrix = flipdot.FlipdotController(args.port, args.width)
@@ -33,6 +36,7 @@ def main():
         matrix.set_backlight(False)
 
     if args.action == 'clock':
+        graphics.precompute_clock('analog_clock')
         old_minute = None
         while True:
             now = datetime.datetime.now()
@@ -40,7 +44,7 @@ def main():
                 graphics.text(now.strftime("%H:%M"), size = 22, x = 44)
                 #graphics.text(now.strftime("%d.%m.%y"), align = 'left', valign = 'top', size = 4, font = "fonts/itty.ttf")
                 #graphics.bitmap(graphics.img_binary_clock(block_width = 4, block_height = 4), align = 'left', valign = 'bottom')
-                graphics.bitmap(graphics.img_analog_clock(), align = 'right', valign = 'middle')
+                graphics.analog_clock(halign = 'right', valign = 'middle')
                 graphics.commit()
             old_minute = now.minute
             time.sleep(1)
@@ -54,13 +58,14 @@ def main():
             old_minute = now.minute
             time.sleep(1)
     elif args.action == 'mediumclock':
+        graphics.precompute_clock('binary_clock', block_width = 4, block_height = 4)
         old_minute = None
         while True:
             now = datetime.datetime.now()
             if now.minute != old_minute:
                 graphics.text(now.strftime("%H:%M"), size = 22, x = 30)
                 graphics.text(now.strftime("%d.%m.%y"), align = 'left', valign = 'top', size = 4, font = "Itty")
-                graphics.bitmap(graphics.img_binary_clock(block_width = 4, block_height = 4), align = 'left', valign = 'bottom')
+                graphics.binary_clock(block_width = 4, block_height = 4, halign = 'left', valign = 'bottom')
                 graphics.commit()
             old_minute = now.minute
             time.sleep(1)
@@ -77,21 +82,23 @@ def main():
         if args.image:
             img = Image.open(args.image)
             if img.format == 'GIF':
-                while True:
-                    img = Image.open(args.image)
-                    for frame in ImageSequence.Iterator(img):
-                        graphics.bitmap(frame)
-                        graphics.commit()
-                        time.sleep(args.delay)
-                    if not args.loop:
-                        break
-                    del img # If we don't completely reload the image, the first frame will be skipped (the last one will be displayed instead) on any but the first cycles
+                # All frames are decoded once, the delay is only used for frames without their own duration
+                animation = flipdot.Animation.from_image(img, matrix.width, matrix.height, default_duration = args.delay, dither = args.dither)
+                player = flipdot.AnimationPlayer(matrix, animation)
+                try:
+                    player.play(loop = args.loop)
+                finally:
+                    print("{frames_shown} frames shown, {frames_dropped} dropped, {achieved_fps:.1f} of {target_fps:.1f} fps".format(**player.get_stats()))
             else:
-                graphics.bitmap(img)
+                graphics.bitmap(img, dither = args.dither)
                 graphics.commit()
         elif args.text:
             graphics.text(args.text, args.font, args.size, args.horizontal_align, args.vertical_align)
             graphics.commit()
+        elif args.marquee:
+            marquee = graphics.get_marquee(args.marquee, args.font, args.size, speed = args.speed, valign = args.vertical_align)
+            for value, mask in marquee.frames(loops = None if args.loop else 1):
+                matrix.send_bitmap(value.data)
         elif args.vertical_text:
             graphics.vertical_text(args.vertical_text, args.font, args.size, args.horizontal_align, args.vertical_align)
             graphics.commit()
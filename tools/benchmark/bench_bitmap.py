@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This program compares the speed of the image/bitmap conversions against the old per-pixel implementations.
+It also measures rendering an image file with Atkinson dithering, converting it every time
+compared to the asset cache, which converts it once.
+"""
+
+import argparse
+import flipdot
+import os
+import random
+import tempfile
+import timeit
+
+from PIL import Image
+
+def legacy_image_to_bitmap(image):
+    # The original implementation, walking every pixel in Python
+    img = image.convert('L')
+    pixels = img.load()
+    width, height = img.size
+    bitmap = []
+    for x in range(width):
+        col_byte = 0x00
+        for y in range(height):
+            if pixels[x, y] > 127:
+                col_byte += 1 << (8 - y%8 - 1)
+            if (y+1) % 8 == 0:
+                bitmap.append(col_byte)
+                col_byte = 0x00
+    return bitmap
+
+def legacy_bitmap_to_image(bitmap, height):
+    # The original implementation, setting every pixel in Python
+    width = round(len(bitmap)/2)
+    img = Image.new('L', (width, height), 'black')
+    pixels = img.load()
+    for index, col_byte in enumerate(bitmap):
+        x = int(index/2)
+        for byte_pos in range(8):
+            y = byte_pos + 8*(index%2)
+            pixels[x, y] = 255 * (col_byte & (1 << (7-byte_pos)))
+    return img
+
+def random_image(width, height):
+    img = Image.new('L', (width, height), 'black')
+    img.putdata([random.randint(0, 255) for i in range(width * height)])
+    return img
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--width', type = int, default = 126, required = False)
+    parser.add_argument('-ht', '--height', type = int, default = 16, required = False)
+    parser.add_argument('-n', '--number', type = int, default = 1000, required = False)
+    args = parser.parse_args()
+
+    graphics = flipdot.FlipdotGraphics(flipdot.DummyFlipdotController(args.width, args.height))
+    img = random_image(args.width, args.height)
+
+    bitmap = graphics.image_to_bitmap(img)
+
+    if bitmap != legacy_image_to_bitmap(img):
+        raise SystemExit("Bitmaps differ, refusing to benchmark")
+    if args.height == 16 and list(graphics.bitmap_to_image(bitmap).getdata()) != list(legacy_bitmap_to_image(bitmap, args.height).getdata()):
+        raise SystemExit("Decoded images differ, refusing to benchmark")
+
+    print("{0}x{1} image, {2} iterations".format(args.width, args.height, args.number))
+
+    legacy = timeit.timeit(lambda: legacy_image_to_bitmap(img), number = args.number)
+    current = timeit.timeit(lambda: graphics.image_to_bitmap(img), number = args.number)
+    print("Encoding")
+    print("  Per-pixel loop: {0:8.1f} µs/frame".format(legacy / args.number * 1e6))
+    print("  Packed:         {0:8.1f} µs/frame".format(current / args.number * 1e6))
+    print("  Speedup:        {0:8.1f}x".format(legacy / current))
+
+    if args.height == 16:
+        # The old decoder only handled 16 pixel high displays
+        legacy = timeit.timeit(lambda: legacy_bitmap_to_image(bitmap, args.height), number = args.number)
+        current = timeit.timeit(lambda: graphics.bitmap_to_image(bitmap, args.width, args.height), number = args.number)
+        print("Decoding")
+        print("  Per-pixel loop: {0:8.1f} µs/frame".format(legacy / args.number * 1e6))
+        print("  Packed:         {0:8.1f} µs/frame".format(current / args.number * 1e6))
+        print("  Speedup:        {0:8.1f}x".format(legacy / current))
+
+    path = os.path.join(tempfile.mkdtemp(), "dither.png")
+    img.save(path)
+    def convert_file():
+        graphics.sprite(*flipdot.Framebuffer.from_image_with_mask(Image.open(path).convert('RGBA'), 'atkinson'))
+    legacy = timeit.timeit(convert_file, number = args.number)
+    current = timeit.timeit(lambda: graphics.bitmap(path, dither = 'atkinson'), number = args.number)
+    print("Atkinson dithered file")
+    print("  Every render:   {0:8.1f} µs/frame".format(legacy / args.number * 1e6))
+    print("  Asset cache:    {0:8.1f} µs/frame".format(current / args.number * 1e6))
+    print("  Speedup:        {0:8.1f}x".format(legacy / current))
+
+if __name__ == "__main__":
+    main()
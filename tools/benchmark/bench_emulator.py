@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This program measures frame rate and acknowledgement latency of a display behind the emulated muxer,
+with the emulator throttled to the baud rate and flip speed of real hardware.
+It compares full frames against partial updates for frames that change completely and frames that change in a few columns.
+The existing firmware doesn't support partial updates, so the emulated display only accepts them with --partial-updates.
+Without it, the controller falls back to full frames like it would on real hardware.
+"""
+
+import argparse
+import flipdot
+import random
+import threading
+import time
+
+def random_frames(width, number):
+    return [bytes(random.getrandbits(8) for i in range(2*width)) for n in range(number)]
+
+def small_change_frames(width, number):
+    # A few columns changing, like the seconds of a clock
+    frames = []
+    fb = flipdot.Framebuffer(width, 16)
+    for n in range(number):
+        for x in range(width - 6, width - 2):
+            fb.set_column(x, random.getrandbits(16))
+        frames.append(bytes(fb.data))
+    return frames
+
+def run(port, width, frames, partial_updates):
+    controller = flipdot.FlipdotController(port, width, using_mux = True, mux_port = 0, partial_updates = partial_updates)
+    latencies = []
+    start = time.perf_counter()
+    for frame in frames:
+        send_start = time.perf_counter()
+        controller.send_bitmap(frame)
+        latencies.append(time.perf_counter() - send_start)
+    duration = time.perf_counter() - start
+    latencies.sort()
+    return len(frames) / duration, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--width', type = int, default = 126, required = False)
+    parser.add_argument('-n', '--number', type = int, default = 200, required = False)
+    parser.add_argument('-b', '--baudrate', type = int, default = 115200, required = False)
+    parser.add_argument('-fl', '--flip-latency', type = float, default = 0.00002, required = False)
+    parser.add_argument('-pu', '--partial-updates', action = 'store_true',
+        help = "Let the emulated display accept partial updates, which the existing firmware doesn't")
+    args = parser.parse_args()
+
+    emulator = flipdot.FlipdotEmulator({'bench': {'width': args.width, 'height': 16, 'address': 0}},
+        baudrate = args.baudrate, flip_latency = args.flip_latency, partial_updates = args.partial_updates)
+    paths = []
+    thread = threading.Thread(target = emulator.serve_pty, args = (paths.append,))
+    thread.daemon = True
+    thread.start()
+    while not paths:
+        time.sleep(0.01)
+    port = flipdot.get_serial_port(paths[0])
+
+    print("{0} frames of {1} columns at {2} baud, {3} ms per dot".format(args.number, args.width, args.baudrate, args.flip_latency * 1000))
+    for name, frames in (("Random frames", random_frames(args.width, args.number)), ("Small changes", small_change_frames(args.width, args.number))):
+        print(name)
+        for partial_updates in (False, True):
+            fps, median, p99 = run(port, args.width, frames, partial_updates)
+            print("  {0:16} {1:7.1f} frames/s, latency median {2:6.1f} ms, 99th percentile {3:6.1f} ms".format(
+                "Partial updates:" if partial_updates else "Full frames:", fps, median * 1000, p99 * 1000))
+    emulator.stop()
+
+if __name__ == "__main__":
+    main()
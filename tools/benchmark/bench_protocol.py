@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This program compares size and encode/decode cost per frame of a data message carrying a bitmap submessage,
+in framing version 1 with the bitmap as a list and in framing version 2 with the bitmap in base64.
+"""
+
+import argparse
+import flipdot
+import random
+import timeit
+
+def build_message(bitmap):
+    return {'type': 'data', 'display': 'front', 'message': {'type': 'single', 'submessages': [{'type': 'bitmap', 'bitmap': bitmap}]}}
+
+def encode(bitmap, version, encoding):
+    return flipdot.encode_message(build_message(flipdot.encode_bitmap(bitmap, encoding)), version)
+
+def decode(raw_message):
+    message, version = flipdot.decode_message(raw_message)
+    return bytes(flipdot.decode_bitmap(message['message']['submessages'][0]['bitmap']))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--width', type = int, default = 126, required = False)
+    parser.add_argument('-n', '--number', type = int, default = 10000, required = False)
+    args = parser.parse_args()
+
+    bitmap = bytes(random.getrandbits(8) for i in range(2*args.width))
+    print("{0} column bitmap, {1} iterations".format(args.width, args.number))
+    for name, version, encoding in (("Version 1, list", 1, 'list'), ("Version 2, base64", 2, 'base64')):
+        raw_message = encode(bitmap, version, encoding)
+        if decode(raw_message) != bitmap:
+            raise SystemExit("Decoded bitmap differs, refusing to benchmark")
+        encode_time = timeit.timeit(lambda: encode(bitmap, version, encoding), number = args.number)
+        decode_time = timeit.timeit(lambda: decode(raw_message), number = args.number)
+        print(name)
+        print("  Size:   {0:8d} bytes/frame".format(len(raw_message)))
+        print("  Encode: {0:8.1f} µs/frame".format(encode_time / args.number * 1e6))
+        print("  Decode: {0:8.1f} µs/frame".format(decode_time / args.number * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This program measures how many mux transactions per second the controller can send through a pseudo terminal.
+The other end of the pty acknowledges every complete transaction, so only the cost of the host side is measured.
+It compares the single-write transmit buffer against the old way of writing the mux header byte by byte.
+"""
+
+import argparse
+import flipdot
+import os
+import serial
+import threading
+import time
+
+class LegacyController(flipdot.FlipdotController):
+    # Sends messages the way the controller used to, with four separate writes for the mux header
+    def prepare_message(self, *args):
+        self.legacy_message = bytearray([0xFF])
+        for arg in args:
+            if type(arg) is int:
+                self.legacy_message.append(arg)
+            else:
+                self.legacy_message += bytearray(arg)
+
+    def communicate(self, columns = 0):
+        if self.using_mux:
+            self.write(0xF0)
+            self.write(0xC0 + self.mux_port)
+            self.write(len(self.legacy_message) >> 8)
+            self.write(len(self.legacy_message) & 0xFF)
+        self.write(self.legacy_message)
+        return self.check_status()
+
+def acknowledge(fd, stop):
+    # Read complete mux transactions from the master side of the pty and answer each one with 0xFF
+    buf = bytearray()
+    while not stop.is_set():
+        try:
+            buf += os.read(fd, 4096)
+        except OSError:
+            break
+        while len(buf) >= 4:
+            length = (buf[2] << 8) + buf[3]
+            if len(buf) < 4 + length:
+                break
+            del buf[:4 + length]
+            os.write(fd, b"\xff")
+
+def run(controller_class, port, width, number):
+    controller = controller_class(port, width, using_mux = True, mux_port = 0)
+    bitmaps = [bytes([i % 256]) * (2*width) for i in range(number)]
+    start = time.perf_counter()
+    for bitmap in bitmaps:
+        controller.send_bitmap(bitmap, force = True)
+    return number / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--width', type = int, default = 126, required = False)
+    parser.add_argument('-n', '--number', type = int, default = 2000, required = False)
+    args = parser.parse_args()
+
+    master, slave = os.openpty()
+    stop = threading.Event()
+    thread = threading.Thread(target = acknowledge, args = (master, stop))
+    thread.daemon = True
+    thread.start()
+    port = serial.Serial(os.ttyname(slave), baudrate = 115200, timeout = 5)
+
+    print("{0} transactions of {1} columns each".format(args.number, args.width))
+    legacy = run(LegacyController, port, args.width, args.number)
+    print("Five writes per transaction: {0:8.0f} transactions/s".format(legacy))
+    current = run(flipdot.FlipdotController, port, args.width, args.number)
+    print("One write per transaction:   {0:8.0f} transactions/s".format(current))
+    print("Speedup:                     {0:8.2f}x".format(current / legacy))
+    stop.set()
+
+if __name__ == "__main__":
+    main()
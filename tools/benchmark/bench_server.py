@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This program measures how many requests per second the server answers with many clients sending requests in parallel,
+against emulated displays. It compares the server's listener against the old one handling one connection at a time,
+and clients opening a new connection for every request against clients keeping their connection open.
+Optionally, a client connects without sending anything, to show how a stalled client affects the others.
+Beforehand, it checks that a pipelining client rejected by a server with too many connections reports the server's error.
+"""
+
+import argparse
+import flipdot
+import os
+import socket
+import tempfile
+import threading
+import time
+import traceback
+
+DISPLAYS = {
+    'side': {'width': 84, 'height': 16, 'address': 0},
+    'front': {'width': 126, 'height': 16, 'address': 1}
+}
+
+class LegacyServer(flipdot.FlipdotServer):
+    # The old listener, receiving and answering one connection after another
+    def network_listen(self):
+        self.socket.bind(('', self.port))
+        self.socket.settimeout(5.0)
+        self.socket.listen(1)
+        try:
+            while self.running:
+                try:
+                    conn, addr = self.socket.accept()
+                    messages = flipdot.receive_message(conn)
+                    if type(messages) not in (list, tuple):
+                        messages = [messages]
+                    reply = {'success': True}
+                    for message in messages:
+                        reply = self.process_message(message)
+                        if not reply.get('success'):
+                            break
+                    if reply:
+                        flipdot.send_message(conn, reply)
+                    conn.close()
+                except (socket.timeout, ConnectionError):
+                    pass
+                except:
+                    traceback.print_exc()
+        finally:
+            self.socket.close()
+
+def start_server(server_class, port, **kwargs):
+    paths = []
+    emulator = flipdot.FlipdotEmulator(DISPLAYS)
+    thread = threading.Thread(target = emulator.serve_pty, args = (paths.append,))
+    thread.daemon = True
+    thread.start()
+    while not paths:
+        time.sleep(0.01)
+    server = server_class(paths[0], DISPLAYS, port = port, verbose = False, **kwargs)
+    thread = threading.Thread(target = server.run)
+    thread.daemon = True
+    thread.start()
+    time.sleep(0.5)
+    return server, emulator
+
+def stall(port, duration):
+    # Connect and don't send anything for a while
+    sock = socket.create_connection(("localhost", port))
+    time.sleep(duration)
+    sock.close()
+
+def client(port, number, keep_alive, latencies, errors):
+    client = flipdot.FlipdotClient("localhost", port, timeout = 30.0, keep_alive = keep_alive)
+    for i in range(number):
+        start = time.perf_counter()
+        try:
+            if i % 10 == 0:
+                client.add_graphics_submessage('front', 'rectangle', points = [0, 0, i % 126, 15])
+                client.commit()
+            else:
+                client.get_config()
+        except (socket.error, OSError, ValueError):
+            errors.append(i)
+            continue
+        latencies.append(time.perf_counter() - start)
+    client.close()
+
+def check_rejection(port):
+    # Occupy the only connection the server accepts, so the pipelined requests are rejected
+    server, emulator = start_server(flipdot.FlipdotServer, port, max_connections = 1)
+    sock = socket.create_connection(("localhost", port))
+    time.sleep(0.1)
+    client = flipdot.FlipdotClient("localhost", port, protocol_version = 2)
+    try:
+        client.send_pipelined([{'type': 'query-config'}] * 3)
+        error = None
+    except (socket.error, OSError, ValueError) as err:
+        error = err
+    finally:
+        client.close()
+        sock.close()
+        server.stop()
+        emulator.stop()
+    if not isinstance(error, ValueError) or "Too many connections" not in str(error):
+        raise SystemExit("Rejected pipelined requests didn't report the server's error: {0!r}".format(error))
+
+def run(server_class, port, clients, number, keep_alive, stall_duration):
+    server, emulator = start_server(server_class, port)
+    latencies = []
+    errors = []
+    if stall_duration:
+        threading.Thread(target = stall, args = (port, stall_duration), daemon = True).start()
+        time.sleep(0.1)
+    threads = [threading.Thread(target = client, args = (port, number, keep_alive, latencies, errors)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    server.stop()
+    emulator.stop()
+    latencies.sort()
+    return len(latencies) / duration, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], len(errors)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type = int, default = 18200, required = False)
+    parser.add_argument('-c', '--clients', type = int, default = 16, required = False)
+    parser.add_argument('-n', '--number', type = int, default = 50, required = False)
+    parser.add_argument('-s', '--stall', type = float, default = 0.0, required = False,
+        help = "Let one client stall for this many seconds")
+    args = parser.parse_args()
+
+    # The server saves its configuration in the working directory
+    os.chdir(tempfile.mkdtemp())
+    check_rejection(args.port + 10)
+    print("{0} clients with {1} requests each{2}".format(args.clients, args.number,
+        ", one client stalling for {0} s".format(args.stall) if args.stall else ""))
+    variants = (
+        ("One connection at a time", LegacyServer, False),
+        ("Thread pool", flipdot.FlipdotServer, False),
+        ("Thread pool, keep-alive", flipdot.FlipdotServer, True)
+    )
+    for index, (name, server_class, keep_alive) in enumerate(variants):
+        rate, median, p99, errors = run(server_class, args.port + index, args.clients, args.number, keep_alive, args.stall)
+        print("{0:25} {1:7.1f} requests/s, latency median {2:7.1f} ms, 99th percentile {3:7.1f} ms, {4} errors".format(
+            name + ":", rate, median * 1000, p99 * 1000, errors))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This program compares a viewer polling the server with query-bitmap against a viewer subscribed to the display,
+while a client changes the display at a fixed rate. It reports how many changes each viewer saw, how long it took
+to see them and how many bytes it received. Optionally, some subscribers never read their frames,
+to show that they don't slow down the display updates.
+"""
+
+import argparse
+import flipdot
+import os
+import socket
+import tempfile
+import threading
+import time
+
+DISPLAYS = {
+    'front': {'width': 126, 'height': 16, 'address': 0}
+}
+
+def start_server(port):
+    paths = []
+    emulator = flipdot.FlipdotEmulator(DISPLAYS)
+    threading.Thread(target = emulator.serve_pty, args = (paths.append,), daemon = True).start()
+    while not paths:
+        time.sleep(0.01)
+    server = flipdot.FlipdotServer(paths[0], DISPLAYS, port = port, verbose = False)
+    threading.Thread(target = server.run, daemon = True).start()
+    time.sleep(0.5)
+    return server, emulator
+
+def rectangle_width(bitmap):
+    # The changes draw a rectangle of a different width each time, which can be read from the top row
+    return sum(1 for col in range(len(bitmap) // 2) if bitmap[col*2] & 0x80)
+
+def writer(port, rate, duration, changes):
+    client = flipdot.FlipdotClient("localhost", port)
+    end = time.perf_counter() + duration
+    index = 0
+    while time.perf_counter() < end:
+        width = index % 100 + 2
+        changes[width] = time.perf_counter()
+        client.add_graphics_submessage('front', 'rectangle', points = [0, 0, width - 1, 15])
+        client.commit()
+        index += 1
+        time.sleep(1.0 / rate)
+    client.close()
+
+def poll(port, interval, stop, seen, received):
+    client = flipdot.FlipdotClient("localhost", port)
+    while not stop.is_set():
+        reply = client.send_raw_message(client.build_bitmap_query_message(['front']))
+        received[0] += len(flipdot.encode_message(reply, client.protocol_version))
+        seen.append((rectangle_width(reply['front'] or []), time.perf_counter()))
+        time.sleep(interval)
+    client.close()
+
+def subscribe(port, stop, seen, received):
+    client = flipdot.FlipdotClient("localhost", port)
+    frames = client.subscribe(['front'], timeout = 0.5)
+    try:
+        while not stop.is_set():
+            try:
+                frame = next(frames)
+            except socket.timeout:
+                continue
+            received[0] += len(flipdot.encode_message(dict(frame, bitmap = flipdot.encode_bitmap(frame['bitmap'])), client.protocol_version))
+            seen.append((rectangle_width(frame['bitmap']), time.perf_counter()))
+    finally:
+        frames.close()
+
+def stalled_subscriber(port, stop):
+    # Subscribe and never read anything
+    sock = socket.create_connection(("localhost", port))
+    flipdot.send_message(sock, {'type': 'subscribe', 'displays': ['front'], 'encoding': 'list'})
+    stop.wait()
+    sock.close()
+
+def run(port, viewer, args):
+    server, emulator = start_server(port)
+    stop = threading.Event()
+    for i in range(args.stalled):
+        threading.Thread(target = stalled_subscriber, args = (port, stop), daemon = True).start()
+    changes = {}
+    seen = []
+    received = [0]
+    thread = threading.Thread(target = viewer, args = (port, stop, seen, received))
+    thread.start()
+    time.sleep(0.2)
+    writer(port, args.rate, args.duration, changes)
+    time.sleep(0.2)
+    stop.set()
+    thread.join()
+    server.stop()
+    emulator.stop()
+
+    # Latency from sending a change to seeing it for the first time
+    first_seen = {}
+    for width, seen_time in seen:
+        if width in changes and width not in first_seen:
+            first_seen[width] = seen_time
+    latencies = [seen_time - changes[width] for width, seen_time in first_seen.items()]
+    latencies.sort()
+    median = latencies[len(latencies) // 2] if latencies else float('nan')
+    return len(latencies), len(changes), median, received[0]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type = int, default = 18300, required = False)
+    parser.add_argument('-r', '--rate', type = float, default = 20.0, required = False,
+        help = "Changes per second")
+    parser.add_argument('-d', '--duration', type = float, default = 5.0, required = False)
+    parser.add_argument('-i', '--interval', type = float, default = 0.1, required = False,
+        help = "Polling interval in seconds")
+    parser.add_argument('-s', '--stalled', type = int, default = 0, required = False,
+        help = "Number of subscribers that never read their frames")
+    args = parser.parse_args()
+
+    # The server saves its configuration in the working directory
+    os.chdir(tempfile.mkdtemp())
+    print("{0} changes per second for {1} s{2}".format(args.rate, args.duration,
+        ", {0} stalled subscribers".format(args.stalled) if args.stalled else ""))
+    variants = (
+        ("Polling every {0} s".format(args.interval), lambda port, stop, seen, received: poll(port, args.interval, stop, seen, received)),
+        ("Subscription", subscribe)
+    )
+    for index, (name, viewer) in enumerate(variants):
+        seen, changes, median, received = run(args.port + index, viewer, args)
+        print("{0:22} {1:4d} of {2:4d} changes seen, latency median {3:6.1f} ms, {4:8d} bytes received".format(
+            name + ":", seen, changes, median * 1000, received))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This program measures what a monitoring client checking the configuration, message and bitmap of the displays costs
+when it sends plain queries every time, compared to conditional queries with if_newer_than and bitmap deltas.
+It does so once with displays that don't change and once with a few columns changing between checks, like a clock.
+"""
+
+import argparse
+import flipdot
+import os
+import tempfile
+import threading
+import time
+
+DISPLAYS = {
+    'side': {'width': 84, 'height': 16, 'address': 0},
+    'front': {'width': 126, 'height': 16, 'address': 1}
+}
+
+class CountingClient(flipdot.FlipdotClient):
+    # Counts the bytes of all replies, including their headers
+    received = 0
+
+    def connect(self):
+        super().connect()
+        read_exactly = self.reader.read_exactly
+        def counting_read_exactly(size, deadline = None):
+            self.received += size
+            return read_exactly(size, deadline)
+        self.reader.read_exactly = counting_read_exactly
+
+def start_server(port):
+    paths = []
+    emulator = flipdot.FlipdotEmulator(DISPLAYS, baudrate = 0)
+    threading.Thread(target = emulator.serve_pty, args = (paths.append,), daemon = True).start()
+    while not paths:
+        time.sleep(0.01)
+    server = flipdot.FlipdotServer(paths[0], DISPLAYS, port = port, verbose = False)
+    threading.Thread(target = server.run, daemon = True).start()
+    time.sleep(0.5)
+    return server, emulator
+
+def show(client, step):
+    for display, config in DISPLAYS.items():
+        client.add_graphics_submessage(display, 'rectangle', points = [config['width'] - 6, 0, config['width'] - 6 + step % 5, 15])
+    client.commit()
+
+def check_plain(client, state):
+    client.get_config()
+    client.get_message()
+    client.get_bitmap()
+
+def check_conditional(client, state):
+    for name, query in (('config', client.get_config), ('message', client.get_message)):
+        reply = query(if_newer_than = state.get(name, 0))
+        state[name] = dict((display, value['version']) for display, value in reply.items())
+    client.sync_bitmaps()
+
+def run(client, writer, check, number, changing):
+    state = {}
+    check(client, state)
+    client.received = 0
+    duration = 0.0
+    for i in range(number):
+        if changing:
+            show(writer, i)
+            time.sleep(0.02)
+        start = time.perf_counter()
+        check(client, state)
+        duration += time.perf_counter() - start
+    return client.received / number, duration / number
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type = int, default = 18400, required = False)
+    parser.add_argument('-n', '--number', type = int, default = 100, required = False)
+    args = parser.parse_args()
+
+    # The server saves its configuration in the working directory
+    os.chdir(tempfile.mkdtemp())
+    server, emulator = start_server(args.port)
+    writer = flipdot.FlipdotClient("localhost", args.port)
+    show(writer, 0)
+    time.sleep(0.2)
+    print("{0} checks of {1} displays".format(args.number, len(DISPLAYS)))
+    for changing in (False, True):
+        print("Small changes between checks:" if changing else "No changes between checks:")
+        for name, check in (("Plain queries", check_plain), ("Conditional queries", check_conditional)):
+            client = CountingClient("localhost", args.port)
+            size, duration = run(client, writer, check, args.number, changing)
+            client.close()
+            print("  {0:20} {1:7.0f} bytes/check, {2:6.2f} ms/check".format(name + ":", size, duration * 1000))
+    writer.close()
+    server.stop()
+    emulator.stop()
+
+if __name__ == "__main__":
+    main()
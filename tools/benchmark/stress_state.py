@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This program lets many threads send data, control and query messages to the server at the same time,
+while the control loop renders messages with dynamic submessages on emulated displays.
+Afterwards it checks that the state the control loop works on matches the state requested by the clients
+and that no display has to be updated anymore once its message is cleared.
+It also checks that a health query for an unknown display is answered with an error.
+Finally, it reports how many messages were processed per second and how many errors were printed.
+"""
+
+import argparse
+import contextlib
+import flipdot
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+DISPLAYS = {
+    'side': {'width': 84, 'height': 16, 'address': 0},
+    'front': {'width': 126, 'height': 16, 'address': 1}
+}
+
+CONFIG_KEYS = ('backlight', 'inverting', 'active', 'quick_update')
+
+def random_message(display):
+    kind = random.randrange(6)
+    if kind == 0:
+        return {'type': 'control', 'display': display, 'message': {random.choice(CONFIG_KEYS): random.random() < 0.5}}
+    elif kind == 1:
+        return {'type': 'data', 'display': display, 'message': {'type': 'single', 'submessages': [
+            {'type': 'graphics', 'func': 'rectangle', 'params': {'points': [0, 0, random.randrange(84), 15]}},
+            {'type': 'graphics', 'func': 'line', 'refresh_interval': 0.01, 'params': {'points': [0, 0, random.randrange(84), 15]}}
+        ]}}
+    elif kind == 2:
+        return {'type': 'data', 'display': display, 'message': {'type': 'sequence', 'interval': 0.02, 'messages': [
+            {'type': 'single', 'submessages': [{'type': 'graphics', 'func': 'rectangle', 'params': {'points': [0, 0, 10, 10]}}]},
+            {'type': 'single', 'submessages': [{'type': 'graphics', 'func': 'line', 'params': {'points': [0, 0, 20, 15]}}]}
+        ]}}
+    return {'type': random.choice(('query-config', 'query-message', 'query-bitmap', 'query-health')), 'displays': [display]}
+
+def hammer(server, number, failures):
+    for i in range(number):
+        reply = server.process_message(random_message(random.choice(list(DISPLAYS))))
+        if reply.get('success') is False:
+            failures.append(reply)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--threads', type = int, default = 8, required = False)
+    parser.add_argument('-n', '--number', type = int, default = 2000, required = False)
+    args = parser.parse_args()
+
+    # The server saves its configuration in the working directory
+    os.chdir(tempfile.mkdtemp())
+    emulator = flipdot.FlipdotEmulator(DISPLAYS, baudrate = 0)
+    paths = []
+    threading.Thread(target = emulator.serve_pty, args = (paths.append,), daemon = True).start()
+    while not paths:
+        time.sleep(0.01)
+    server = flipdot.FlipdotServer(paths[0], DISPLAYS, port = 0, verbose = False, save_delay = 0.05)
+    server.running = True
+    server.persister_thread.start()
+    control_thread = threading.Thread(target = server.control_loop)
+
+    # Count the tracebacks printed by any of the server's threads
+    stderr = io.StringIO()
+    failures = []
+    threads = [threading.Thread(target = hammer, args = (server, args.number, failures)) for i in range(args.threads)]
+    with contextlib.redirect_stderr(stderr):
+        control_thread.start()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+        # Let the control loop take all remaining commands
+        while server.commands:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        server.running = False
+        server.wakeup.set()
+        control_thread.join()
+        # Clearing the messages must not leave deadlines of their dynamic submessages behind
+        for display in DISPLAYS:
+            server.process_message({'type': 'data', 'display': display, 'message': None})
+        server.apply_commands()
+        stale_deadlines = [display for display in DISPLAYS if server.update_display(display, time.time()) is not None]
+        # Unknown displays are answered with an error instead of dropping the connection
+        health_reply = server.process_message({'type': 'query-health', 'displays': ['side', 'unknown']})
+        server.stop()
+        server.persister_thread.join()
+    emulator.stop()
+
+    mismatches = [display for display in DISPLAYS if server.update_data[display]['config'] != server.config[display]
+        or server.update_data[display]['message'] != server.current_message[display]]
+    tracebacks = stderr.getvalue().count("Traceback")
+    print("{0} threads with {1} messages each: {2:.0f} messages/s".format(args.threads, args.number, args.threads * args.number / duration))
+    print("Rejected messages: {0}, tracebacks: {1}, displays out of sync: {2}".format(len(failures), tracebacks, ", ".join(mismatches) or "none"))
+    print("Displays with deadlines after clearing their message: {0}".format(", ".join(stale_deadlines) or "none"))
+    health_rejected = health_reply == {'success': False, 'error': "Invalid display: unknown"}
+    print("Health query for an unknown display: {0}".format("rejected" if health_rejected else health_reply))
+    if tracebacks:
+        sys.stderr.write(stderr.getvalue())
+    if failures or tracebacks or mismatches or stale_deadlines or not health_rejected:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
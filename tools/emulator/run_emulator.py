@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This program emulates flipdot displays on a pseudo terminal or a TCP socket, so the server and matrix.py can be run without hardware.
+By default, it emulates the displays configured in server.py behind a muxer:
+
+    ./run_emulator.py
+    ../../server.py -p /dev/pts/5
+
+Single displays without a muxer, as used by matrix.py, can be emulated too:
+
+    ./run_emulator.py --no-mux -d 28x16@0
+    ../../matrix.py -p /dev/pts/5 -w 28 -t Test
+"""
+
+import argparse
+import flipdot
+
+def parse_display(value):
+    # WIDTHxHEIGHT@ADDRESS, optionally prefixed with NAME=
+    name, sep, spec = value.rpartition("=")
+    size, sep, address = spec.partition("@")
+    width, sep, height = size.partition("x")
+    return name or "display{0}".format(address or 0), {'width': int(width), 'height': int(height or 16), 'address': int(address or 0)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--display', type = parse_display, action = 'append', required = False,
+        help = "Display as [NAME=]WIDTHxHEIGHT@ADDRESS, can be given multiple times")
+    parser.add_argument('-b', '--baudrate', type = int, default = 115200, required = False,
+        help = "Throttle messages to this baud rate, 0 to disable")
+    parser.add_argument('-fl', '--flip-latency', type = float, default = 0.0, required = False,
+        help = "Seconds it takes to flip a single dot")
+    parser.add_argument('-s', '--socket', type = int, required = False,
+        help = "Listen on this TCP port instead of creating a pseudo terminal")
+    parser.add_argument('-nm', '--no-mux', action = 'store_true')
+    parser.add_argument('-pu', '--partial-updates', action = 'store_true',
+        help = "Accept partial updates, which the existing firmware answers with an error")
+    parser.add_argument('-sh', '--show', action = 'store_true',
+        help = "Print the displays whenever they change")
+    parser.add_argument('-v', '--verbose', action = 'store_true')
+    args = parser.parse_args()
+
+    if args.display:
+        displays = dict(args.display)
+    else:
+        displays = {
+            'side': {'width': 84, 'height': 16, 'address': 0},
+            'panel': {'width': 28, 'height': 16, 'address': 1},
+            'front': {'width': 126, 'height': 16, 'address': 2}
+        }
+
+    emulator = flipdot.FlipdotEmulator(displays, baudrate = args.baudrate, flip_latency = args.flip_latency,
+        using_mux = not args.no_mux, partial_updates = args.partial_updates, verbose = args.verbose)
+
+    if args.show:
+        # Show the displays after every message that changed them
+        feed = emulator.feed
+        def feed_and_show(data, now = None):
+            flipped = [display.stats['dots_flipped'] for display in emulator.displays.values()]
+            answers = feed(data, now)
+            for display, old in zip(emulator.displays.values(), flipped):
+                if display.stats['dots_flipped'] != old:
+                    print("{0} (backlight {1}):".format(emulator.names[display.address], "on" if display.backlight else "off"))
+                    print(display.render())
+            return answers
+        emulator.feed = feed_and_show
+
+    try:
+        if args.socket:
+            emulator.serve_socket(args.socket)
+        else:
+            emulator.serve_pty(lambda path: print("Serial port: {0}".format(path), flush = True))
+    except KeyboardInterrupt:
+        pass
+    for address, display in sorted(emulator.displays.items()):
+        print("{0}: {1}".format(emulator.names[address], display.stats))
+    print(emulator.stats)
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 This program can connect to a flipdot server and generate a realistic image of the selected matrix display.
+With --follow, it stays subscribed to the display and generates the image again whenever the display changes.
 """
 
 skeleton_xml = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
@@ -127,23 +128,7 @@ import argparse
 import flipdot
 import subprocess
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-s', '--server', type = str, required = False, default = "localhost")
-    parser.add_argument('-p', '--port', type = int, required = False, default = 1820)
-    parser.add_argument('-d', '--display', type = str, required = True)
-    parser.add_argument('-o', '--output-file', type = str, required = True)
-    parser.add_argument('-png', '--png', action = 'store_true')
-    args = parser.parse_args()
-
-    client = flipdot.FlipdotClient(args.server, args.port)
-    hwconfig = client.get_hwconfig()
-    display = hwconfig[args.display]
-    config = client.get_config([args.display])[args.display]
-    bitmap = client.get_bitmap([args.display])[args.display]
-
-    backlight = config['backlight']
-
+def generate_image(display, bitmap, backlight, output_file, png):
     data = ""
     for row in range(display['height']):
         for col in range(display['width']):
@@ -167,7 +152,7 @@ def main():
 
             data += pixel_xml.format(**pixel_data)
 
-    with open(args.output_file, 'w') as f:
+    with open(output_file, 'w') as f:
         f.write(skeleton_xml.format(**{
             'data': data,
             'width': display['width'] * 57.2,
@@ -175,8 +160,35 @@ def main():
             'background_color': "00000000"
         }))
 
-    if args.png:
-        subprocess.call(("rsvg-convert", args.output_file, "-o", args.output_file + ".png"))
+    if png:
+        subprocess.call(("rsvg-convert", output_file, "-o", output_file + ".png"))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--server', type = str, required = False, default = "localhost")
+    parser.add_argument('-p', '--port', type = int, required = False, default = 1820)
+    parser.add_argument('-d', '--display', type = str, required = True)
+    parser.add_argument('-o', '--output-file', type = str, required = True)
+    parser.add_argument('-png', '--png', action = 'store_true')
+    parser.add_argument('-f', '--follow', action = 'store_true',
+        help = "Keep generating the image whenever the display changes")
+    args = parser.parse_args()
+
+    client = flipdot.FlipdotClient(args.server, args.port)
+    hwconfig = client.get_hwconfig()
+    display = hwconfig[args.display]
+    config = client.get_config([args.display])[args.display]
+
+    if args.follow:
+        # The backlight state is read once, only bitmap changes are pushed by the server
+        try:
+            for frame in client.subscribe([args.display]):
+                generate_image(display, frame['bitmap'], config['backlight'], args.output_file, args.png)
+        except KeyboardInterrupt:
+            pass
+    else:
+        bitmap = client.get_bitmap([args.display])[args.display]
+        generate_image(display, bitmap, config['backlight'], args.output_file, args.png)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file